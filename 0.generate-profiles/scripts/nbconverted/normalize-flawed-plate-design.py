@@ -10,12 +10,12 @@
 # In[1]:
 
 
+import sys
 import pathlib
 import numpy as np
 import pandas as pd
 
 import statsmodels.api as sm
-from sklearn import decomposition
 from statsmodels.formula.api import ols
 
 import plotnine as gg
@@ -23,6 +23,9 @@ import plotnine as gg
 from pycytominer import normalize
 from pycytominer.cyto_utils import infer_cp_features
 
+sys.path.insert(0, "../scripts")
+from projection_utils import fit_projection
+
 
 # In[2]:
 
@@ -33,8 +36,8 @@ def test_batch_effect_contribution(df, n_components, pca_columns, model_formula)
 
     feature_df = df.loc[:, features]
 
-    pca = decomposition.PCA(n_components=n_components).fit(feature_df)
-    pca_batch_df = pca.transform(feature_df)
+    # Reuse the cached projection if this feature space was already decomposed
+    pca_batch_df = fit_projection(feature_df, n_components=n_components)["scores"]
 
     pca_batch_df = pd.concat(
         [
@@ -0,0 +1,262 @@
+import os
+import sys
+import yaml
+import pathlib
+import numpy as np
+import pandas as pd
+
+from pycytominer.cyto_utils import infer_cp_features
+
+from scripts.viz_utils import (
+    plot_replicate_correlation,
+    plot_replicate_density,
+    plot_site_correlation,
+)
+
+# Blockwise similarity helpers are shared with 2.describe-data (repository "scripts")
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2] / "scripts"))
+from similarity_utils import (
+    get_similarity_matrix,
+    get_upper_pairs,
+    get_group_codes,
+    get_percent_strong,
+    get_pair_histograms,
+    get_histogram_density,
+)
+
+general_site_audit_cols = ["Metadata_Well", "Metadata_Site", "Metadata_Plate"]
+
+
+def load_audit_config(config_file, profile_dir):
+    """
+    Parse the audit configuration yaml (one document per batch) into a dictionary
+    of batch to plates, audit columns, whether to process the batch, and the
+    profile file of each plate
+    """
+    audit_config = {}
+    with open(config_file, "r") as stream:
+        for data in yaml.load_all(stream, Loader=yaml.FullLoader):
+            batch = data["batch"]
+            audit_level = data["auditlevel"]
+            plates = [str(x) for x in data["plates"]]
+            audit_config[batch] = {}
+            audit_config[batch]["plates"] = plates
+            audit_config[batch]["auditcols"] = data["auditcols"]
+            audit_config[batch]["process"] = data["process"]
+            audit_config[batch]["plate_files"] = {
+                x: os.path.join(
+                    profile_dir, batch, x, "{}_{}.csv.gz".format(x, audit_level)
+                )
+                for x in plates
+            }
+    return audit_config
+
+
+def audit_replicates(
+    df,
+    features,
+    replicate_groups,
+    quantile=0.95,
+    similarity_metric="pearson",
+):
+    """
+    Audit replicate reproducibility of a plate from a single similarity matrix
+
+    Arguments:
+    df - pandas dataframe of profiles
+    features - the feature columns
+    replicate_groups - the metadata columns defining replicates
+    quantile - the quantile of the non replicate null distribution used as cutoff
+    similarity_metric - "pearson" or "spearman"
+
+    Output:
+    A dictionary of the audit pairs (a dataframe with the pair indices, the
+    similarity_metric, the {group}_pair_a and {group}_pair_b metadata of each
+    replicate group, and whether the pair is a group_replicate), the null cutoff,
+    and the percent strong
+    """
+    similarity_matrix = get_similarity_matrix(
+        df, features, similarity_metric=similarity_metric
+    )
+    pair_a, pair_b, similarity = get_upper_pairs(similarity_matrix)
+
+    group_codes = get_group_codes(df, replicate_groups)
+    replicate_mask = group_codes[pair_a] == group_codes[pair_b]
+
+    cutoff, percent_strong = get_percent_strong(
+        similarity, replicate_mask, quantile=quantile
+    )
+
+    audit_df = pd.DataFrame(
+        {
+            "pair_a_index": pair_a,
+            "pair_b_index": pair_b,
+            "similarity_metric": similarity,
+        }
+    )
+    for group in replicate_groups:
+        group_values = df.loc[:, group].to_numpy()
+        audit_df[f"{group}_pair_a"] = group_values[pair_a]
+        audit_df[f"{group}_pair_b"] = group_values[pair_b]
+    audit_df["group_replicate"] = replicate_mask
+
+    audit_results = {
+        "audit_df": audit_df,
+        "cutoff": cutoff,
+        "percent_strong": percent_strong,
+    }
+    return audit_results
+
+
+def get_site_replicate_cols(audit_cols):
+    """
+    The columns defining replicates of a site audit: clone (and treatment), or cell
+    line and dosage for the earliest batches
+    """
+    if "Metadata_clone_number" in audit_cols:
+        replicate_cols = ["Metadata_clone_number"]
+        if "Metadata_treatment" in audit_cols:
+            replicate_cols += ["Metadata_treatment"]
+    else:
+        replicate_cols = ["Metadata_Dosage", "Metadata_CellLine"]
+    return replicate_cols
+
+
+def get_site_audit(df, audit_cols, features=None, block_size=2000):
+    """
+    Density of site profile correlations for replicate and non replicate pairs, in
+    same or different wells and sites, streamed with get_pair_histograms()
+    """
+    if features is None:
+        features = infer_cp_features(df)
+
+    hist_df = get_pair_histograms(
+        df,
+        features=features,
+        pair_groups={
+            "replicate": get_site_replicate_cols(audit_cols),
+            "same_well": ["Metadata_Well"],
+            "same_site": ["Metadata_Site"],
+        },
+        block_size=block_size,
+    )
+
+    hist_df = hist_df.assign(
+        same_well_diff_site=(hist_df.same_well & ~hist_df.same_site).replace(
+            {True: "Same Well", False: "Different Well"}
+        ),
+        same_site=hist_df.same_site.replace(
+            {True: "Same Site", False: "Different Site"}
+        ),
+    )
+
+    return get_histogram_density(
+        hist_df, groups=["same_well_diff_site", "same_site", "replicate"]
+    )
+
+
+def audit_plate(
+    batch,
+    plate,
+    plate_file,
+    audit_cols,
+    figure_dir,
+    site_audit=True,
+    quantile=0.95,
+    block_size=2000,
+    output_file_extensions=[".png"],
+    seed=1234,
+):
+    """
+    Run every audit of one plate from a single read of its profiles: replicate
+    correlation (and site correlation, for site level profiles), and save figures.
+    The random seed (for jittered points) is set here, so figures are reproducible
+    in any worker process.
+
+    Output:
+    a dictionary summarizing the plate audit
+    """
+    print("Now auditing... Batch: {}; Plate: {}".format(batch, plate))
+    np.random.seed(seed)
+    figure_output_dir = os.path.join(figure_dir, batch, plate)
+    os.makedirs(figure_output_dir, exist_ok=True)
+
+    df = pd.read_csv(plate_file)
+    features = infer_cp_features(df)
+
+    audit_results = audit_replicates(
+        df=df,
+        features=features,
+        replicate_groups=audit_cols,
+        quantile=quantile,
+        similarity_metric="pearson",
+    )
+    audit_df = audit_results["audit_df"]
+    cutoff = audit_results["cutoff"]
+    percent_strong = audit_results["percent_strong"]
+
+    grid_string = "~{}".format("+".join([f"{x}_pair_a" for x in audit_cols]))
+
+    # Visualize the audit - output two plots for each plate
+    output_base = os.path.join(
+        figure_output_dir, "{}_{}_replicate_correlation".format(batch, plate)
+    )
+    plot_replicate_correlation(
+        df=audit_df,
+        batch=batch,
+        plate=plate,
+        facet_string=grid_string,
+        dpi=500,
+        split_samples=True,
+        output_file_base=output_base,
+        output_file_extensions=output_file_extensions,
+    )
+
+    output_base = os.path.join(figure_output_dir, "{}_{}_density".format(batch, plate))
+    plot_replicate_density(
+        df=audit_df,
+        batch=batch,
+        plate=plate,
+        cutoff=cutoff,
+        percent_strong=percent_strong,
+        dpi=500,
+        output_file_base=output_base,
+        output_file_extensions=output_file_extensions,
+    )
+
+    audit_summary = {
+        "batch": batch,
+        "plate": plate,
+        "n_profiles": df.shape[0],
+        "n_pairs": audit_df.shape[0],
+        "n_replicate_pairs": int(audit_df.group_replicate.sum()),
+        "quantile": quantile,
+        "cutoff": cutoff,
+        "percent_strong": percent_strong,
+    }
+
+    # Release the pairwise audit before the site audit
+    del audit_df, audit_results
+
+    # Site profiles are also compared within and across wells and sites
+    site_audit = site_audit and "Metadata_Site" in df.columns
+    if site_audit:
+        site_df = get_site_audit(
+            df,
+            audit_cols=audit_cols + general_site_audit_cols,
+            features=features,
+            block_size=block_size,
+        )
+        output_base = os.path.join(
+            figure_output_dir, "{}_{}_site_correlation".format(batch, plate)
+        )
+        plot_site_correlation(
+            df=site_df,
+            batch=batch,
+            plate=plate,
+            output_file_base=output_base,
+            output_file_extensions=output_file_extensions,
+        )
+
+    audit_summary["site_audit"] = site_audit
+    return audit_summary
@@ -1,5 +1,6 @@
 import numpy as np
 import plotnine as gg
+import matplotlib.pyplot as plt
 
 
 def save_figure(
@@ -10,11 +11,18 @@ def save_figure(
     height=6,
     width=8,
 ):
+    # Draw the figure once and write every extension from the same render
+    figure = (main_figure + gg.theme(figure_size=(width, height), dpi=dpi)).draw()
     for extension in extensions:
         output_file = "{}{}".format(file_base, extension)
-        main_figure.save(
-            filename=output_file, dpi=dpi, height=height, width=width, verbose=False
+        figure.savefig(
+            output_file,
+            dpi=dpi,
+            bbox_inches="tight",
+            facecolor=figure.get_facecolor(),
+            edgecolor=figure.get_edgecolor(),
         )
+    plt.close(figure)
 
 
 def plot_replicate_correlation(
@@ -118,3 +126,34 @@ def plot_replicate_density(
 
     if return_plot:
         return density_gg
+
+
+def plot_site_correlation(
+    df,
+    batch,
+    plate,
+    output_file_base=None,
+    output_file_extensions=[".png", ".pdf", ".svg"],
+    dpi=300,
+    height=3,
+    width=4,
+    return_plot=False,
+):
+    site_audit_gg = (
+        gg.ggplot(df, gg.aes(x="bin_center", y="density"))
+        + gg.geom_area(gg.aes(fill="replicate"), alpha=0.5, position="identity")
+        + gg.theme_bw()
+        + gg.facet_grid("same_well_diff_site~same_site")
+        + gg.ggtitle("{}: {}".format(batch, plate))
+        + gg.xlab("Pairwise Pearson Correlation")
+        + gg.ylab("Density")
+        + gg.theme(strip_background=gg.element_rect(colour="black", fill="#fdfff4"))
+    )
+
+    if output_file_base:
+        save_figure(
+            site_audit_gg, output_file_base, output_file_extensions, dpi, height, width
+        )
+
+    if return_plot:
+        return site_audit_gg
@@ -12,14 +12,16 @@
 
 
 import os
+import sys
 import numpy as np
 import pandas as pd
-import umap
 
 import plotnine as gg
 
 from pycytominer import feature_select
-from pycytominer.cyto_utils import infer_cp_features
+
+sys.path.insert(0, "../scripts")
+from embedding_utils import process_umap
 
 
 # In[2]:
@@ -34,27 +36,6 @@ get_ipython().run_line_magic('matplotlib', 'inline')
 np.random.seed(123)
 
 
-# In[4]:
-
-
-def process_umap(data_df):    
-    # Prepare UMAP input by removing metadata columns
-    metadata_cols = infer_cp_features(data_df, metadata=True)
-
-    metadata_df = data_df.loc[:, metadata_cols]
-    umap_data_df = data_df.drop(metadata_cols, axis="columns")
-    
-    # Apply UMAP
-    reducer = umap.UMAP(random_state=123)
-    embedding = reducer.fit_transform(umap_data_df)
-    
-    # Setup plotting logic
-    embedding_df = pd.DataFrame(embedding, columns=['x', 'y'])
-    embedding_df = embedding_df.merge(metadata_df, left_index=True, right_index=True)
-    
-    return embedding_df
-
-
 # In[5]:
 
 
@@ -10,17 +10,23 @@
 # In[1]:
 
 
+import sys
 import pathlib
 import pandas as pd
 import plotnine as gg
 
-from cytominer_eval import evaluate
-from cytominer_eval.transform import metric_melt
-from cytominer_eval.operations.util import assign_replicates
 from pycytominer.cyto_utils import infer_cp_features
 
 from scripts.processing_utils import load_data
 
+sys.path.insert(0, "../scripts")
+from similarity_utils import (
+    get_cross_batch_similarity,
+    summarize_similarity,
+    get_histogram_density,
+    evaluate_profiles,
+)
+
 
 # In[2]:
 
@@ -72,65 +78,66 @@ full_datasets_df.head()
 # In[5]:
 
 
-# Melt a pairwise similarity matrix
-similarity_melted_df = metric_melt(
+# Aggregate pairwise similarities per comparison category, one batch by batch block at a time
+replicate_groups = ["Metadata_clone_number", "Metadata_treatment"]
+similarity_results = get_cross_batch_similarity(
     df=full_datasets_df,
     features=features,
-    metadata_features=meta_features,
-    similarity_metric="pearson",
-    eval_metric="grit",
+    batch_col="Metadata_batch",
+    replicate_groups=replicate_groups,
+    pair_a_groups=["Metadata_clone_number"],
 )
 
-# Determine which samples are replicates
-replicate_groups = ["Metadata_batch", "Metadata_clone_number", "Metadata_treatment"]
-similarity_melted_df = assign_replicates(
-    similarity_melted_df=similarity_melted_df,
-    replicate_groups=replicate_groups
-)
+similarity_hist_df = similarity_results["histogram"]
 
 
 # In[6]:
 
 
-same_treatment_across_batch_replicate = (
-    similarity_melted_df.Metadata_clone_number_replicate &
-    similarity_melted_df.Metadata_treatment_replicate &
-    ~(similarity_melted_df.Metadata_batch_replicate)
-)
-
-different_treatment_within_batch = (
-    similarity_melted_df.Metadata_batch_replicate &
-    ~(similarity_melted_df.group_replicate) 
+# Summarize each comparison category and batch
+summarize_similarity(
+    similarity_results, groups=["comparison_category", "Metadata_batch_pair_a"]
 )
 
 
 # In[7]:
 
 
-similarity_melted_df = similarity_melted_df.assign(comparison_category="across_batch_nonreplicate")
-similarity_melted_df.loc[similarity_melted_df.group_replicate, "comparison_category"] = "same_batch_replicate"
-similarity_melted_df.loc[same_treatment_across_batch_replicate, "comparison_category"] = "across_batch_replicate"
-similarity_melted_df.loc[different_treatment_within_batch, "comparison_category"] = "same_batch_nonreplicate"
+# Similarity densities by comparison category, within each batch and clone subset
+resistant_clones = ['WT_parental', 'CloneA', 'CloneE']
+
+all_density_df = get_histogram_density(similarity_hist_df, groups=["comparison_category"])
+batch_density_df = get_histogram_density(
+    similarity_hist_df, groups=["comparison_category", "Metadata_batch_pair_a"]
+)
+clone_density_df = get_histogram_density(
+    similarity_hist_df.query("Metadata_clone_number_pair_a in @resistant_clones"),
+    groups=["comparison_category", "Metadata_batch_pair_a"]
+)
+other_clone_density_df = get_histogram_density(
+    similarity_hist_df.query("Metadata_clone_number_pair_a not in @resistant_clones"),
+    groups=["comparison_category", "Metadata_batch_pair_a"]
+)
 
 
 # In[8]:
 
 
-similarity_melted_df.comparison_category.value_counts()
+summarize_similarity(similarity_results, groups=["comparison_category"])
 
 
 # In[9]:
 
 
-similarity_melted_df.Metadata_clone_number_pair_a.value_counts()
+similarity_hist_df.groupby("Metadata_clone_number_pair_a")["count"].sum()
 
 
 # In[10]:
 
 
 (
-    gg.ggplot(similarity_melted_df, gg.aes(x="similarity_metric"))
-    + gg.geom_density(gg.aes(fill="comparison_category"), alpha=0.5)
+    gg.ggplot(all_density_df, gg.aes(x="bin_center", y="density"))
+    + gg.geom_area(gg.aes(fill="comparison_category"), alpha=0.5, position="identity")
     + gg.theme_bw()
 )
 
@@ -139,8 +146,8 @@ similarity_melted_df.Metadata_clone_number_pair_a.value_counts()
 
 
 (
-    gg.ggplot(similarity_melted_df, gg.aes(x="similarity_metric"))
-    + gg.geom_density(gg.aes(fill="comparison_category"), alpha=0.5)
+    gg.ggplot(batch_density_df, gg.aes(x="bin_center", y="density"))
+    + gg.geom_area(gg.aes(fill="comparison_category"), alpha=0.5, position="identity")
     + gg.theme_bw()
     + gg.facet_wrap("~Metadata_batch_pair_a")
 )
@@ -150,10 +157,8 @@ similarity_melted_df.Metadata_clone_number_pair_a.value_counts()
 
 
 (
-    gg.ggplot(
-        similarity_melted_df.query("Metadata_clone_number_pair_a in ['WT_parental', 'CloneA', 'CloneE']"),
-        gg.aes(x="similarity_metric"))
-    + gg.geom_density(gg.aes(fill="comparison_category"), alpha=0.5)
+    gg.ggplot(clone_density_df, gg.aes(x="bin_center", y="density"))
+    + gg.geom_area(gg.aes(fill="comparison_category"), alpha=0.5, position="identity")
     + gg.theme_bw()
     + gg.facet_wrap("~Metadata_batch_pair_a")
 )
@@ -163,10 +168,8 @@ similarity_melted_df.Metadata_clone_number_pair_a.value_counts()
 
 
 (
-    gg.ggplot(
-        similarity_melted_df.query("Metadata_clone_number_pair_a not in ['WT_parental', 'CloneA', 'CloneE']"),
-        gg.aes(x="similarity_metric"))
-    + gg.geom_density(gg.aes(fill="comparison_category"), alpha=0.5)
+    gg.ggplot(other_clone_density_df, gg.aes(x="bin_center", y="density"))
+    + gg.geom_area(gg.aes(fill="comparison_category"), alpha=0.5, position="identity")
     + gg.theme_bw()
     + gg.facet_wrap("~Metadata_batch_pair_a")
 )
@@ -231,16 +234,20 @@ data_df.Metadata_treatment_profile_id.value_counts()
 # In[19]:
 
 
-# Get replicate correlation
-percent_strong, corr_df = evaluate(
-    profiles=data_df,
+# Get replicate correlation and technical grit for batch from one similarity matrix
+evaluate_results = evaluate_profiles(
+    df=data_df,
     features=features,
-    meta_features=meta_features,
     replicate_groups=["Metadata_clone_number", "Metadata_treatment"],
-    operation="replicate_reproducibility",
-    replicate_reproducibility_return_median_cor=True
+    grit_profile_col="Metadata_treatment_profile_id",
+    grit_group_col="Metadata_treatment_group_id",
+    grit_control_perts=all_grit_control_perts,
+    grit_subset=data_df.Metadata_batch.isin(select_batches),
 )
 
+percent_strong = evaluate_results["percent_strong"]
+corr_df = evaluate_results["median_cor_df"]
+
 
 # In[20]:
 
@@ -258,19 +265,7 @@ corr_df.head()
 
 
 # Get technical grit for batch
-replicate_groups = {
-    "profile_col": "Metadata_treatment_profile_id",
-    "replicate_group_col": "Metadata_treatment_group_id"
-}
-
-grit_df = evaluate(
-    profiles=data_df.query("Metadata_batch in @select_batches"),
-    features=features,
-    meta_features=meta_features,
-    replicate_groups=replicate_groups,
-    operation="grit",
-    grit_control_perts=all_grit_control_perts
-)
+grit_df = evaluate_results["grit_df"]
 
 
 # In[23]:
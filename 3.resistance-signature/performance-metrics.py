@@ -0,0 +1,53 @@
+"""
+Script to calculate signature performance metrics for all datasets in a configuration file
+"""
+
+import pathlib
+import argparse
+import pandas as pd
+from joblib import Parallel, delayed
+
+from utils.performance_utils import load_performance_config, get_performance_results
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--config",
+    help="configuration yaml file with singscore results and comparisons per dataset",
+    default="performance_config.yaml",
+)
+parser.add_argument(
+    "--output_dir",
+    help="directory where to save performance results",
+    default="results/performance",
+)
+parser.add_argument(
+    "--n_jobs", help="number of datasets to process in parallel", default=-1, type=int
+)
+args = parser.parse_args()
+
+output_dir = pathlib.Path(args.output_dir)
+output_dir.mkdir(parents=True, exist_ok=True)
+
+# Load configuration file info
+performance_config = load_performance_config(args.config)
+
+# Load each singscore results file once, even if it is evaluated in several ways
+results_dfs = {}
+for name, dataset_config in performance_config.items():
+    results_file = dataset_config["results_file"]
+    if results_file not in results_dfs:
+        print("Now loading... {}".format(results_file))
+        results_dfs[results_file] = pd.read_csv(results_file, sep="\t")
+
+# Compute real, shuffled, bootstrap and ROC metrics of all datasets in one pass
+print("Now calculating performance... {}".format(", ".join(performance_config)))
+all_output_results = Parallel(n_jobs=args.n_jobs)(
+    delayed(get_performance_results)(
+        results_dfs[dataset_config["results_file"]], dataset_config
+    )
+    for dataset_config in performance_config.values()
+)
+
+for output_results in all_output_results:
+    for output_file, output_df in output_results.items():
+        output_df.to_csv(pathlib.Path(output_dir, output_file), sep="\t", index=False)
@@ -45,7 +45,7 @@ from sklearn.metrics import accuracy_score, average_precision_score
 
 import plotnine as gg
 
-from utils.metrics import get_metrics, get_metric_pipeline
+from utils.metrics import get_metrics, get_metric_pipeline, get_bootstrap_pipeline
 
 
 # In[2]:
@@ -68,6 +68,14 @@ output_dir = pathlib.Path("results", "performance")
 num_permutations = 100
 threshold = 0
 
+# Resample profiles within plates to estimate confidence intervals
+num_bootstraps = 1000
+bootstrap_seed = 1234
+bootstrap_strata = {
+    "total": "Metadata_Plate",
+    "sample": "Metadata_Plate"
+}
+
 metric_comparisons = {
     "total": ["Metadata_model_split"],
     "plate": ["Metadata_model_split", "Metadata_Plate"],
@@ -140,6 +148,22 @@ roc_scores_df.columns = ["roc_auc", "model_split", "shuffled"]
 roc_curve_data_df = pd.concat(roc_curve_data).reset_index(drop=True)
 
 
+# In[ ]:
+
+
+# Get bootstrap confidence intervals of performance metrics using real predictions
+bootstrap_metric_results = get_bootstrap_pipeline(
+    results_df,
+    metric_comparisons,
+    datasets=[dataset],
+    num_bootstraps=num_bootstraps,
+    strata=bootstrap_strata,
+    signature=False,
+    threshold=threshold,
+    random_state=bootstrap_seed
+)
+
+
 # In[8]:
 
 
@@ -153,6 +177,9 @@ for compare in metric_comparisons:
     
     output_file = pathlib.Path(f"{output_dir}/{compare}_{dataset}_shuffle_metric_performance.tsv")
     shuffle_results_df.to_csv(output_file, sep="\t", index=False)
+
+    output_file = pathlib.Path(f"{output_dir}/{compare}_{dataset}_bootstrap_metric_performance.tsv")
+    bootstrap_metric_results[compare].to_csv(output_file, sep="\t", index=False)
     
 # Output ROC results
 output_file = pathlib.Path(f"{output_dir}/{dataset}_roc_auc.tsv")
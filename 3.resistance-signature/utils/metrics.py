@@ -1,3 +1,5 @@
+import sys
+import pathlib
 import numpy as np
 import pandas as pd
 
@@ -8,6 +10,10 @@ from sklearn.metrics import (
     roc_auc_score,
 )
 
+# Curve helpers are shared with the single cell models (repository "scripts")
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2] / "scripts"))
+from curve_utils import downsample_curve
+
 
 def apply_shuffle(score):
     """A helper function to randomly permute scores
@@ -57,7 +63,9 @@ def assign_pred_score(df, threshold=0, shuffle=False):
     return df
 
 
-def get_metrics(df, return_roc_curve=False, threshold=0, shuffle=False):
+def get_metrics(
+    df, return_roc_curve=False, threshold=0, shuffle=False, roc_max_points=None
+):
     """A helper function to output various performance metrics
 
     Parameters
@@ -72,6 +80,12 @@ def get_metrics(df, return_roc_curve=False, threshold=0, shuffle=False):
     shuffle : bool, optional
         Whether or not to shuffle the actual signature scores before computing metrics.
         Defaults to False.
+    roc_max_points : int, optional
+        The maximum number of points in the output roc curve. Longer curves keep the
+        points bracketing evenly spaced false positive rates (see
+        :py:func:`downsample_curve`). The roc auc is computed from the full data, so
+        the area under the reduced curve may differ slightly from it. Defaults to
+        None, which outputs every threshold.
 
     Returns
     -------
@@ -92,6 +106,9 @@ def get_metrics(df, return_roc_curve=False, threshold=0, shuffle=False):
 
         roc_curve_results = pd.DataFrame(roc_curve_results).transpose()
         roc_curve_results.columns = ["fpr", "tpr", "threshold"]
+        roc_curve_results = downsample_curve(
+            roc_curve_results, "fpr", "tpr", max_points=roc_max_points
+        )
 
         df = assign_pred_score(df, threshold=threshold, shuffle=shuffle)
         roc_auc = roc_auc_score(
@@ -175,3 +192,198 @@ def get_metric_pipeline(
         ).reset_index(drop=True)
 
     return metric_results
+
+
+def bootstrap_confusion_counts(
+    y_true, y_pred, num_bootstraps=1000, strata=None, random_state=None
+):
+    """Draw bootstrap resamples of profiles as confusion matrix counts
+
+    Parameters
+    ----------
+    y_true : array-like
+        binary ground truth status of each profile
+    y_pred : array-like
+        binary predicted status of each profile
+    num_bootstraps : int, optional
+        How many bootstrap resamples to draw. Defaults to 1000.
+    strata : array-like, optional
+        Labels (e.g. plate or clone) of each profile. If provided, profiles are
+        resampled within each stratum, keeping stratum sizes fixed. Defaults to None.
+    random_state : int or numpy.random.RandomState, optional
+        Seed of the bootstrap draws. Defaults to None.
+
+    Returns
+    -------
+    numpy.ndarray
+        A (num_bootstraps, 4) array of true negative, false positive, false negative
+        and true positive counts per resample
+
+    Notes
+    -----
+    With binary predictions a resample only matters through its confusion matrix, and
+    resampling n profiles with replacement is equivalent to drawing the matrix from a
+    multinomial of the observed cell proportions, so all resamples of a stratum are
+    drawn at once without materializing profile weights.
+    """
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+
+    cells = 2 * np.asarray(y_true, dtype=int) + np.asarray(y_pred, dtype=int)
+    if strata is None:
+        strata = np.zeros(cells.shape[0], dtype=int)
+    strata_codes, _ = pd.factorize(np.asarray(strata))
+
+    counts = np.zeros((num_bootstraps, 4), dtype=np.int64)
+    for stratum in np.unique(strata_codes):
+        stratum_cells = np.bincount(cells[strata_codes == stratum], minlength=4)
+        stratum_size = stratum_cells.sum()
+        counts += random_state.multinomial(
+            stratum_size, stratum_cells / stratum_size, size=num_bootstraps
+        )
+
+    return counts
+
+
+def get_confusion_metrics(counts):
+    """Compute performance metrics of binary predictions from confusion matrix counts
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        A (n, 4) array of true negative, false positive, false negative and true
+        positive counts (see :py:func:`bootstrap_confusion_counts`)
+
+    Returns
+    -------
+    dict
+        arrays of accuracy, average precision and roc auc, matching accuracy_score,
+        average_precision_score and roc_auc_score of binary predictions. Metrics that
+        are undefined for a row (e.g. no positive profiles) are NaN.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    tn, fp, fn, tp = counts.T
+    total = counts.sum(axis=1)
+    pos = tp + fn
+    neg = tn + fp
+    pred_pos = tp + fp
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tpr = np.where(pos > 0, tp / pos, np.nan)
+        fpr = np.where(neg > 0, fp / neg, np.nan)
+        precision = np.where(pred_pos > 0, tp / pred_pos, 0)
+
+        # Binary scores give at most two thresholds: predicted positive, and everything
+        avg_prec = tpr * precision + (1 - tpr) * pos / total
+        roc_auc = (1 + tpr - fpr) / 2
+
+    metric_results = {
+        "accuracy": (tp + tn) / total,
+        "avg_precision": avg_prec,
+        "roc_auc": roc_auc,
+    }
+
+    return metric_results
+
+
+def get_bootstrap_pipeline(
+    df,
+    metric_comparisons,
+    datasets,
+    num_bootstraps=1000,
+    strata=None,
+    ci=0.95,
+    threshold=0,
+    signature=True,
+    random_state=None,
+):
+    """A helper function to output bootstrap confidence intervals of performance metrics
+
+    Paramaters
+    ----------
+    df : pandas.DataFrame
+        a data frame storing metadata and predictions, must include the columns:
+        ("Metadata_clone_type_indicator", "signature", "TotalScore", "dataset")
+    metric_comparisons : dict
+        a dictionary with metadata splits indicating how to track performance
+    datasets : list
+        list of strings indicating which "dataset" to use in calculation
+        (subsets dataset column)
+    num_bootstraps : int, optional
+        How many bootstrap resamples to draw per metadata group. Defaults to 1000.
+    strata : dict, optional
+        metadata column to resample within (e.g. "Metadata_Plate") for each key of
+        metric_comparisons. Comparisons without an entry are resampled across all
+        profiles of a group. Defaults to None.
+    ci : float, optional
+        The width of the percentile confidence interval. Defaults to 0.95.
+    threshold : float, optional
+        How to distinguish positive from negative classes. Defaults to 0.
+    signature : bool, optional
+        In cases with multiple datasets and predictions made across datasets, only
+        track performance for the plates used in the given dataset. Defaults to True.
+    random_state : int or numpy.random.RandomState, optional
+        Seed of the bootstrap draws, independent of the global numpy seed used by the
+        shuffled predictions. Defaults to None.
+
+    Returns
+    -------
+    dict
+        Data frames per metric comparison with the point estimate ("metric_value") and
+        confidence interval ("ci_lower", "ci_upper") of accuracy, average precision and
+        roc auc per metadata group.
+    """
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    if strata is None:
+        strata = {}
+
+    quantiles = [100 * (1 - ci) / 2, 100 * (1 + ci) / 2]
+
+    metric_results = {}
+    for metric_compare in metric_comparisons:
+        metadata_groups = metric_comparisons[metric_compare]
+        strata_col = strata.get(metric_compare)
+        metric_results[metric_compare] = []
+        for dataset in datasets:
+            result_subset_df = df.query("dataset == @dataset")
+
+            if signature:
+                result_subset_df = result_subset_df.query("signature == @dataset")
+
+            result_subset_df = assign_pred_score(
+                result_subset_df, threshold=threshold, shuffle=False
+            )
+
+            for group_id, group_df in result_subset_df.groupby(metadata_groups):
+                y_true = group_df.Metadata_clone_type_indicator.values
+                y_pred = group_df.y_pred.values
+                group_strata = None if strata_col is None else group_df[strata_col].values
+
+                observed_counts = np.bincount(2 * y_true + y_pred, minlength=4)
+                observed = get_confusion_metrics(observed_counts[np.newaxis, :])
+                bootstrap_counts = bootstrap_confusion_counts(
+                    y_true,
+                    y_pred,
+                    num_bootstraps=num_bootstraps,
+                    strata=group_strata,
+                    random_state=random_state,
+                )
+                bootstrap_metrics = get_confusion_metrics(bootstrap_counts)
+
+                if not isinstance(group_id, tuple):
+                    group_id = (group_id,)
+                for metric, values in bootstrap_metrics.items():
+                    ci_lower, ci_upper = np.nanpercentile(values, quantiles)
+                    metric_results[metric_compare].append(
+                        list(group_id)
+                        + [metric, observed[metric][0], ci_lower, ci_upper, dataset]
+                    )
+
+        metric_results[metric_compare] = pd.DataFrame(
+            metric_results[metric_compare],
+            columns=metadata_groups
+            + ["metric", "metric_value", "ci_lower", "ci_upper", "dataset"],
+        )
+
+    return metric_results
@@ -0,0 +1,185 @@
+import pathlib
+import yaml
+import numpy as np
+import pandas as pd
+
+from utils.metrics import get_metrics, get_metric_pipeline, get_bootstrap_pipeline
+
+
+def load_performance_config(config_file):
+    """Load the signature performance configuration
+
+    Parameters
+    ----------
+    config_file : str
+        Path to a yaml file with one document per dataset to evaluate (see
+        performance_config.yaml)
+
+    Returns
+    -------
+    dict
+        Dataset configurations keyed by name, skipping those with process: false
+    """
+    performance_config = {}
+    with open(config_file, "r") as stream:
+        for data in yaml.load_all(stream, Loader=yaml.FullLoader):
+            if not data.get("process", True):
+                continue
+
+            data.setdefault("output_suffix", "")
+            data.setdefault("roc_prefix", data["dataset"])
+            data.setdefault("roc_split_column", None)
+            data.setdefault("roc_splits", [])
+            data.setdefault("roc_max_points", None)
+            data.setdefault("num_bootstraps", 0)
+            data.setdefault("bootstrap_strata", None)
+            data.setdefault("bootstrap_seed", None)
+
+            performance_config[data["name"]] = data
+
+    return performance_config
+
+
+def get_roc_results(results_df, split_column, splits, max_points=None):
+    """Compute ROC AUC and ROC curves with real and shuffled signature scores
+
+    Parameters
+    ----------
+    results_df : pandas.DataFrame
+        singscore results including "Metadata_clone_type_indicator" and "TotalScore"
+    split_column : str
+        Metadata column to subset profiles by. If None, all profiles are used at once.
+    splits : list
+        Values of split_column to compute ROC information for
+    max_points : int, optional
+        The maximum number of points per roc curve. Defaults to None (all thresholds).
+
+    Returns
+    -------
+    tuple
+        Data frames of ROC AUC and ROC curve coordinates
+    """
+    if split_column is None:
+        split_dfs = {None: results_df}
+    else:
+        split_dfs = {
+            split: results_df.loc[results_df[split_column] == split] for split in splits
+        }
+
+    roc_scores = []
+    roc_curve_data = []
+    for split, results_subset_df in split_dfs.items():
+        for shuffle in [True, False]:
+            roc_auc_val, roc_df = get_metrics(
+                df=results_subset_df,
+                return_roc_curve=True,
+                shuffle=shuffle,
+                roc_max_points=max_points,
+            )
+
+            if split_column is None:
+                roc_scores.append(pd.Series([roc_auc_val, shuffle]))
+                roc_curve_data.append(roc_df.assign(shuffled=shuffle))
+            else:
+                roc_scores.append(pd.Series([roc_auc_val, split, shuffle]))
+                roc_curve_data.append(roc_df.assign(model_split=split, shuffled=shuffle))
+
+    roc_scores_df = pd.DataFrame(roc_scores)
+    if split_column is None:
+        roc_scores_df.columns = ["roc_auc", "shuffled"]
+    else:
+        roc_scores_df.columns = ["roc_auc", "model_split", "shuffled"]
+    roc_curve_data_df = pd.concat(roc_curve_data).reset_index(drop=True)
+
+    return roc_scores_df, roc_curve_data_df
+
+
+def get_performance_results(results_df, dataset_config):
+    """Compute all performance metrics of one signature application
+
+    The order of random draws follows the per dataset performance notebooks: real
+    metrics after setting the dataset seed, one seed per permutation for the shuffled
+    metrics, and the ROC shuffles last. The bootstrap uses its own random state.
+
+    Parameters
+    ----------
+    results_df : pandas.DataFrame
+        singscore results of the dataset
+    dataset_config : dict
+        One dataset configuration (see :py:func:`load_performance_config`)
+
+    Returns
+    -------
+    dict
+        Output file names (relative to the output directory) mapped to data frames
+    """
+    dataset = dataset_config["dataset"]
+    metric_comparisons = dataset_config["metric_comparisons"]
+    threshold = dataset_config["threshold"]
+    suffix = dataset_config["output_suffix"]
+    roc_prefix = dataset_config["roc_prefix"]
+
+    np.random.seed(dataset_config["seed"])
+
+    # Get performance metrics using real predictions
+    real_metric_results = get_metric_pipeline(
+        results_df,
+        metric_comparisons,
+        [dataset],
+        shuffle=False,
+        signature=False,
+        threshold=threshold,
+    )
+
+    # Get performance metrics using shuffled predictions
+    all_shuffle_results = {compare: [] for compare in metric_comparisons}
+    for i in range(0, dataset_config["num_permutations"]):
+        np.random.seed(i)
+        shuffle_metric_results = get_metric_pipeline(
+            results_df,
+            metric_comparisons,
+            datasets=[dataset],
+            shuffle=True,
+            signature=False,
+            threshold=threshold,
+        )
+        for compare in metric_comparisons:
+            metric_df = shuffle_metric_results[compare].assign(permutation=i)
+            all_shuffle_results[compare].append(metric_df)
+
+    # Get ROC curve information
+    roc_scores_df, roc_curve_data_df = get_roc_results(
+        results_df,
+        split_column=dataset_config["roc_split_column"],
+        splits=dataset_config["roc_splits"],
+        max_points=dataset_config["roc_max_points"],
+    )
+
+    output_results = {}
+    for compare in metric_comparisons:
+        output_results[f"{compare}_{dataset}_metric_performance{suffix}.tsv"] = (
+            real_metric_results[compare]
+        )
+        output_results[f"{compare}_{dataset}_shuffle_metric_performance{suffix}.tsv"] = (
+            pd.concat(all_shuffle_results[compare]).reset_index(drop=True)
+        )
+
+    if dataset_config["num_bootstraps"] > 0:
+        bootstrap_metric_results = get_bootstrap_pipeline(
+            results_df,
+            metric_comparisons,
+            datasets=[dataset],
+            num_bootstraps=dataset_config["num_bootstraps"],
+            strata=dataset_config["bootstrap_strata"],
+            signature=False,
+            threshold=threshold,
+            random_state=dataset_config["bootstrap_seed"],
+        )
+        for compare in metric_comparisons:
+            output_file = f"{compare}_{dataset}_bootstrap_metric_performance{suffix}.tsv"
+            output_results[output_file] = bootstrap_metric_results[compare]
+
+    output_results[f"{roc_prefix}_roc_auc{suffix}.tsv"] = roc_scores_df
+    output_results[f"{roc_prefix}_roc_curve{suffix}.tsv"] = roc_curve_data_df
+
+    return output_results
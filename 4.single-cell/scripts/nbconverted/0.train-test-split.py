@@ -14,7 +14,13 @@ from sklearn.model_selection import train_test_split
 from pycytominer import feature_select
 from pycytominer.cyto_utils import infer_cp_features
 
-from utils.single_cell_utils import process_sites, normalize_sc
+from utils.single_cell_utils import (
+    process_sites,
+    normalize_sc,
+    fit_normalizer,
+    save_normalizer,
+    set_selected_features,
+)
 sys.path.append("../0.generate-profiles")
 from scripts.profile_util import load_config
 
@@ -37,6 +43,8 @@ cell_lines = ["Clone A", "Clone E", "WT parental"]
 feature_filter = ["Object", "Location", "Count", "Parent"]
 test_split_prop = 0.15
 scaler_method = "standard"
+normalize_chunk_size = 50000
+normalizer_control_query = None
 seed = 123
 
 feature_select_opts = [
@@ -230,7 +238,21 @@ for clone_type, clone_info_dict in imagenumber_dict.items():
 
 # Training and testing sets
 train_df = pd.concat(training_dict_df).sample(frac=1).reset_index(drop=True)
-train_df = normalize_sc(train_df, scaler_method=scaler_method)
+
+# Fit the normalizer once and save it next to the models for later sets and plates
+normalizer = fit_normalizer(
+    train_df,
+    scaler_method=scaler_method,
+    chunk_size=normalize_chunk_size,
+    control_query=normalizer_control_query,
+)
+
+normalizer_file = pathlib.Path("models", "single_cell_normalizer.joblib")
+save_normalizer(normalizer, normalizer_file)
+
+train_df = normalize_sc(
+    train_df, normalizer=normalizer, chunk_size=normalize_chunk_size
+)
 
 train_df, test_df = train_test_split(
     train_df,
@@ -248,7 +270,9 @@ print(test_df.shape)
 
 # Holdout set
 holdout_df = pd.concat(holdout_dict_df).sample(frac=1).reset_index(drop=True)
-holdout_df = normalize_sc(holdout_df, scaler_method=scaler_method)
+holdout_df = normalize_sc(
+    holdout_df, normalizer=normalizer, chunk_size=normalize_chunk_size
+)
 
 print(holdout_df.shape)
 
@@ -258,7 +282,9 @@ print(holdout_df.shape)
 
 # Other data
 other_df = pd.concat(other_dict_df).sample(frac=1).reset_index(drop=True)
-other_df = normalize_sc(other_df, scaler_method=scaler_method)
+other_df = normalize_sc(
+    other_df, normalizer=normalizer, chunk_size=normalize_chunk_size
+)
 
 print(other_df.shape)
 
@@ -290,6 +316,10 @@ train_df = train_df.reindex(reindex_features, axis="columns")
 holdout_df = holdout_df.reindex(reindex_features, axis="columns")
 other_df = other_df.reindex(reindex_features, axis="columns")
 
+# Store the selected features with the normalizer to process new plates
+normalizer = set_selected_features(normalizer, selected_features)
+save_normalizer(normalizer, normalizer_file)
+
 
 # In[20]:
 
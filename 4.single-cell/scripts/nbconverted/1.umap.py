@@ -4,7 +4,7 @@
 # In[1]:
 
 
-import umap
+import sys
 import pathlib
 import warnings
 import pandas as pd
@@ -13,28 +13,28 @@ import plotnine as gg
 from numba.core.errors import NumbaWarning
 
 from utils.data_utils import load_data
+from utils.viz_utils import geom_point_raster
+
+sys.path.insert(0, "../scripts")
+from embedding_utils import (
+    stratified_subsample,
+    build_knn_index,
+    fit_embedding,
+    transform_embedding,
+    get_embedding_df,
+    benchmark_embedding,
+)
 
 
 # In[2]:
 
 
-def apply_umap(x_df, meta_df):
-    reducer = umap.UMAP(random_state=123)
-    embedding_df = reducer.fit_transform(x_df)
-
-    # Setup plotting logic
-    embedding_df = pd.DataFrame(embedding_df, columns=['x', 'y'])
-    embedding_df = embedding_df.merge(meta_df, left_index=True, right_index=True)
-    
-    return embedding_df
-
-
 def plot_umap_cell_line(embedding_df, fig_file, cell_line_column, color_labels, color_values):
     cell_line_gg = (
-        gg.ggplot(embedding_df, gg.aes(x="x", y="y")) +
-        gg.geom_point(gg.aes(color=cell_line_column), size = 0.2, shape = ".", alpha = 0.2) +
+        gg.ggplot() +
+        geom_point_raster(embedding_df, x="x", y="y", color=cell_line_column) +
         gg.theme_bw() +
-        gg.scale_color_manual(name="Cell Line", labels=color_labels, values=color_values)
+        gg.scale_fill_manual(name="Cell Line", labels=color_labels, values=color_values)
         )
 
     cell_line_gg.save(filename=fig_file, height=4, width=5, dpi=500)
@@ -43,8 +43,8 @@ def plot_umap_cell_line(embedding_df, fig_file, cell_line_column, color_labels,
     
 def plot_umap_well(embedding_df, fig_file, well_column):
     well_gg = (
-        gg.ggplot(embedding_df, gg.aes(x="x", y="y")) +
-        gg.geom_point(gg.aes(color=well_column), size = 0.2, shape = ".", alpha = 0.2) +
+        gg.ggplot() +
+        geom_point_raster(embedding_df, x="x", y="y", color=well_column) +
         gg.theme_bw() 
     )
 
@@ -59,7 +59,7 @@ def plot_umap_well(embedding_df, fig_file, well_column):
 
 data_dict = load_data(
     return_meta=True,
-    shuffle_row_order=True,
+    shuffle_row_order=False,
     holdout=True,
     othertreatment=True
 )
@@ -83,12 +83,42 @@ warnings.filterwarnings("ignore", category=NumbaWarning)
 # In[5]:
 
 
+# Fit UMAP once on a stratified subsample of the training set, with a persisted
+# approximate nearest neighbor index, and embed every split into the same space
+n_fit_cells = 50000
+umap_strata = ["Metadata_clone_number", "Metadata_Well"]
+
+fit_index = stratified_subsample(
+    data_dict["train"]["meta"], strata=umap_strata, n_samples=n_fit_cells
+)
+fit_x_df = data_dict["train"]["x"].iloc[fit_index, :]
+
+knn_index = build_knn_index(fit_x_df, n_neighbors=15, metric="euclidean")
+reducer = fit_embedding(fit_x_df, knn_index=knn_index, random_state=123)
+
 embedding_dict = {}
+for data_split, split_dict in data_dict.items():
+    embedding = transform_embedding(reducer, split_dict["x"])
+    embedding_dict[data_split] = get_embedding_df(embedding, split_dict["meta"])
+
+
+# In[ ]:
+
+
+# Compare embedding time and trustworthiness of subsampled fits to a fit on all cells
+# (the exact UMAP on all test cells is slow, so the benchmark is opt in)
+run_benchmark = False
+
+if run_benchmark:
+    benchmark_df = benchmark_embedding(
+        data_dict["test"]["x"],
+        data_dict["test"]["meta"],
+        strata=umap_strata,
+        fit_sizes=[5000, 10000, 25000],
+        include_full=True,
+    )
 
-embedding_dict["train"] = apply_umap(data_dict["train"]["x"], meta_train_df)
-embedding_dict["test"] = apply_umap(data_dict["test"]["x"], meta_test_df)
-embedding_dict["holdout"] = apply_umap(data_dict["holdout"]["x"], meta_holdout_df)
-embedding_dict["othertreatment"] = apply_umap(data_dict["othertreatment"]["x"], meta_other_df)
+    print(benchmark_df)
 
 
 # In[6]:
@@ -120,8 +150,8 @@ for data_fit, embedding_df in embedding_dict.items():
 
 
 treatment_gg = (
-    gg.ggplot(embedding_dict["othertreatment"], gg.aes(x="x", y="y")) +
-    gg.geom_point(gg.aes(color="Metadata_treatment"), size = 0.2, shape = ".", alpha = 0.2) +
+    gg.ggplot() +
+    geom_point_raster(embedding_dict["othertreatment"], x="x", y="y", color="Metadata_treatment") +
     gg.theme_bw() 
 )
 
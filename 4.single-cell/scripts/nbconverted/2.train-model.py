@@ -13,7 +13,7 @@ import matplotlib.pyplot as plt
 
 from joblib import dump
 from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
 from sklearn.metrics import make_scorer, f1_score
 
@@ -21,10 +21,14 @@ from pycytominer.cyto_utils import infer_cp_features
 
 from utils.data_utils import load_data
 from utils.ml_utils import (
-    shuffle_columns,
-    model_apply,
+    shuffle_columns_inplace,
+    get_row_order_folds,
+    WarmStartPathSearchCV,
+    fit_path_searches,
+    score_splits,
     cross_validation_performance,
     output_coefficients,
+    train_streaming_classifier,
 )
 
 
@@ -54,7 +58,8 @@ data_dict = load_data(
     return_meta=True,
     shuffle_row_order=True,
     holdout=True,
-    othertreatment=True
+    othertreatment=True,
+    lazy_shuffle=True
 )
 
 print(data_dict["train"]["x"].shape)
@@ -77,6 +82,9 @@ y_recode_reverse = {y: x for x, y in y_recode.items()}
 y_train = data_dict["train"]["meta"].loc[:, y_column].replace(y_recode)
 y_test = data_dict["test"]["meta"].loc[:, y_column].replace(y_recode)
 
+# Rows are shuffled lazily: folds follow the shuffled order without copying the data
+cv_folds = get_row_order_folds(y_train, data_dict["train"]["row_order"], n_folds)
+
 y_train.head()
 
 
@@ -85,11 +93,6 @@ y_train.head()
 # In[6]:
 
 
-clf_parameters = {
-    'classify__C': cs,
-    'classify__l1_ratio': l1_ratios
-}
-
 estimator = Pipeline(
     steps=[(
         'classify',
@@ -108,20 +111,23 @@ estimator = Pipeline(
 # Custom scorer that optimizes f1 score weighted by class proportion
 weighted_f1_scorer = make_scorer(f1_score, average='weighted')
 
-cv_pipeline = GridSearchCV(
+# Warm start along C for each l1 ratio and fold, and stop non-competitive paths early
+cv_pipeline = WarmStartPathSearchCV(
     estimator=estimator,
-    param_grid=clf_parameters,
+    cs=cs,
+    l1_ratios=l1_ratios,
     n_jobs=-1,
-    cv=n_folds,
+    cv=cv_folds,
     scoring=weighted_f1_scorer,
     return_train_score=True
 )
  
-shuffle_cv_pipeline = GridSearchCV(
+shuffle_cv_pipeline = WarmStartPathSearchCV(
     estimator=estimator,
-    param_grid=clf_parameters,
+    cs=cs,
+    l1_ratios=l1_ratios,
     n_jobs=-1,
-    cv=n_folds,
+    cv=cv_folds,
     scoring=weighted_f1_scorer,
     return_train_score=True
 )
@@ -130,13 +136,13 @@ shuffle_cv_pipeline = GridSearchCV(
 # In[7]:
 
 
-get_ipython().run_cell_magic('time', '', 'cv_pipeline.fit(X=data_dict["train"]["x"], y=y_train.values)')
+get_ipython().run_cell_magic('time', '', 'x_train_shuffled = shuffle_columns_inplace(\n    data_dict["train"]["x"].to_numpy(dtype=np.float32, copy=True)\n)')
 
 
 # In[8]:
 
 
-get_ipython().run_cell_magic('time', '', 'x_train_shuffled_df = data_dict["train"]["x"].apply(shuffle_columns, axis=0, result_type="broadcast")\n\nshuffle_cv_pipeline.fit(X=x_train_shuffled_df, y=y_train.values)')
+get_ipython().run_cell_magic('time', '', '# Fit the real and shuffled searches in one worker pool on shared memory mapped data\nfit_path_searches(\n    {\n        "real": (cv_pipeline, data_dict["train"]["x"]),\n        "shuffled": (shuffle_cv_pipeline, x_train_shuffled),\n    },\n    y=y_train.values,\n    n_jobs=-1,\n)')
 
 
 # ## Visualize Cross Validation Results
@@ -213,35 +219,17 @@ shuff_coef_df.head()
 # In[14]:
 
 
-scores_dict = {}
-for data_fit in data_dict:
-    scores_dict[data_fit] = {}
-    for shuffled in [True, False]:
-        if shuffled:
-            trained_pipeline = shuffle_cv_pipeline
-        else:
-            trained_pipeline = cv_pipeline
-
-        scores_dict[data_fit][f"shuffled_{shuffled}"] = model_apply(
-            model=trained_pipeline.best_estimator,
-            x_df=data_dict[data_fit]["x"],
-            meta_df=data_dict[data_fit]["meta"],
-            y_recode=y_recode_reverse,
-            data_fit=data_fit,
-            shuffled=shuffled
-        )
+# Stream every split through both models in a single chunked pass
+scores_df = score_splits(
+    models={False: cv_pipeline.best_estimator_, True: shuffle_cv_pipeline.best_estimator_},
+    data_dict=data_dict,
+    y_recode=y_recode_reverse,
+)
 
 
 # In[15]:
 
 
-scores_df = []
-for data_fit in data_dict:
-    for shuffled in [False, True]:
-        scores_df.append(scores_dict[data_fit][f"shuffled_{shuffled}"])
-
-scores_df = pd.concat(scores_df, axis="rows").reset_index(drop=True)
-
 output_file = pathlib.Path("scores", "all_single_cell_scores.tsv.gz")
 scores_df.to_csv(output_file, sep="\t", compression="gzip", index=False)
 
@@ -268,3 +256,34 @@ dump(top_shuffle_model, shuffle_model_file)
 
 top_model
 
+
+# ## Out-of-core streaming model
+
+# In[ ]:
+
+
+# Stream class balanced mini batches of every training cell from the memory mapped
+# cache, scoring the test set along the way
+streaming_model, streaming_eval_df = train_streaming_classifier(
+    x=data_dict["train"]["x"].to_numpy(),
+    y=y_train.values,
+    batch_size=10000,
+    n_epochs=5,
+    eval_x=data_dict["test"]["x"].to_numpy(),
+    eval_y=y_test.values,
+    eval_every=10,
+    random_state=0,
+)
+
+streaming_eval_df.tail()
+
+
+# In[ ]:
+
+
+streaming_eval_file = pathlib.Path("scores", "streaming_model_test_performance.tsv")
+streaming_eval_df.to_csv(streaming_eval_file, sep="\t", index=False)
+
+streaming_model_file = pathlib.Path("models", "multiclass_cloneAE_wildtype_streaming.joblib")
+dump(streaming_model, streaming_model_file)
+
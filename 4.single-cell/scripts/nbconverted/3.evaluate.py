@@ -16,7 +16,8 @@ from sklearn.preprocessing import LabelBinarizer
 from sklearn.metrics import confusion_matrix
 
 from utils.data_utils import load_data
-from utils.ml_utils import get_threshold_metrics, model_apply
+from utils.ml_utils import get_threshold_metrics_batch, model_apply
+from utils.viz_utils import geom_point_raster
 
 
 # In[2]:
@@ -143,9 +144,14 @@ wt_gg
 
 
 resistant_clone_gg = (
-    gg.ggplot(scores_df.query("Metadata_clone_number == 'WT parental'"),
-              gg.aes(y="Clone A", x="Clone E")) +
-    gg.geom_point(gg.aes(fill="Metadata_clone_number"), size=0.01, alpha=0.2) +
+    gg.ggplot() +
+    geom_point_raster(
+        scores_df.query("Metadata_clone_number == 'WT parental'"),
+        x="Clone E",
+        y="Clone A",
+        color="Metadata_clone_number",
+        facets=["data_fit", "shuffle_label"],
+    ) +
     gg.facet_grid("data_fit~shuffle_label") +
     gg.xlab("Clone E") +
     gg.ylab("Clone A") +
@@ -353,15 +359,23 @@ aurocs = []
 avg_precisions = []
 roc_dfs = []
 pr_dfs = []
+
+# Curves are reduced to a bounded number of points, metrics use all cells
+curve_max_points = 1000
+
 for data_fit in scores_df.data_fit.unique():
     for shuffled in scores_df.shuffled.unique():
         scores_subset_df = scores_df.query("data_fit == @data_fit").query("shuffled == @shuffled")
         y_subset_df = y_onehot_df.loc[scores_subset_df.index.tolist(), :]
-        for cell_line in cell_line_classes:
-            y_true = y_subset_df.loc[:, cell_line]
-            y_pred = scores_subset_df.loc[:, cell_line]
-            metric_results = get_threshold_metrics(y_true, y_pred, drop_intermediate=False)
 
+        # Sort each subset once for all cell line classes
+        subset_metrics = get_threshold_metrics_batch(
+            y_true=y_subset_df.loc[:, cell_line_classes],
+            y_scores=scores_subset_df.loc[:, cell_line_classes],
+            drop_intermediate=False,
+            max_points=curve_max_points
+        )
+        for cell_line, metric_results in subset_metrics.items():
             auroc_result = metric_results["auroc"]
             avg_precision_result = metric_results["average_precision"]
             roc_df = metric_results["roc_df"]
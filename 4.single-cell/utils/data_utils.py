@@ -1,50 +1,182 @@
+import json
+import hashlib
 import pathlib
+import numpy as np
 import pandas as pd
 from pycytominer.cyto_utils import infer_cp_features
 
+data_dir = pathlib.Path("data")
+default_cache_dir = pathlib.Path(data_dir, "cache")
 
-def load_data(return_meta=False, shuffle_row_order=False, holdout=False, othertreatment=False):
-    output_data_dict = {"train": {}, "test": {}}
-    train_file = pathlib.Path("data", "single_cell_train.tsv.gz")
-    train_df = pd.read_csv(train_file, sep="\t")
 
-    test_file = pathlib.Path("data", "single_cell_test.tsv.gz")
-    test_df = pd.read_csv(test_file, sep="\t")
+def get_file_hash(data_file, block_size=2 ** 20):
+    file_hash = hashlib.md5()
+    with open(data_file, "rb") as stream:
+        for block in iter(lambda: stream.read(block_size), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
 
-    if shuffle_row_order:
-        train_df = train_df.sample(frac=1).reset_index(drop=True)
-        test_df = test_df.sample(frac=1).reset_index(drop=True)
 
-    cp_features = infer_cp_features(train_df)
-    output_data_dict["train"]["x"] = train_df.loc[:, cp_features]
-    output_data_dict["test"]["x"] = test_df.loc[:, cp_features]
+def get_cache_files(data_file, cache_dir=default_cache_dir):
+    """
+    Locations of the binary cache for a single cell file: a float32 feature matrix
+    (.npy), a columnar metadata table (.parquet), and a json manifest describing the
+    source file the cache was built from
+    """
+    data_file = pathlib.Path(data_file)
+    stem = data_file.name.split(".")[0]
+    cache_files = {
+        "features": pathlib.Path(cache_dir, f"{stem}_features.npy"),
+        "meta": pathlib.Path(cache_dir, f"{stem}_meta.parquet"),
+        "manifest": pathlib.Path(cache_dir, f"{stem}_manifest.json"),
+    }
+    return cache_files
 
-    if holdout:
-        output_data_dict["holdout"] = {}
-        holdout_file = pathlib.Path("data", "single_cell_holdout.tsv.gz")
-        holdout_df = pd.read_csv(holdout_file, sep="\t")
-        if shuffle_row_order:
-            holdout_df = holdout_df.sample(frac=1).reset_index(drop=True)
 
-        output_data_dict["holdout"]["x"] = holdout_df.loc[:, cp_features]
+def build_cache(data_file, cache_dir=default_cache_dir):
+    data_file = pathlib.Path(data_file)
+    cache_files = get_cache_files(data_file, cache_dir=cache_dir)
+    pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    df = pd.read_csv(data_file, sep="\t")
+    cp_features = infer_cp_features(df)
+    meta_features = df.drop(cp_features, axis="columns").columns.tolist()
+
+    np.save(cache_files["features"], df.loc[:, cp_features].to_numpy(dtype=np.float32))
+    df.loc[:, meta_features].to_parquet(cache_files["meta"], index=False)
+
+    source_stat = data_file.stat()
+    manifest = {
+        "source": str(data_file),
+        "source_mtime": source_stat.st_mtime,
+        "source_size": source_stat.st_size,
+        "source_md5": get_file_hash(data_file),
+        "features": cp_features,
+        "meta_features": meta_features,
+    }
+
+    # Write the manifest last, so an interrupted build is never considered fresh
+    with open(cache_files["manifest"], "w") as stream:
+        json.dump(manifest, stream, indent=2)
+
+    return manifest
+
+
+def load_manifest(data_file, cache_dir=default_cache_dir, check_hash=False):
+    """
+    Return the cache manifest if the cache is fresh with respect to the source file,
+    otherwise return None. By default, freshness is determined by the source file
+    modification time and size; set check_hash=True to also compare md5 hashes.
+    """
+    data_file = pathlib.Path(data_file)
+    cache_files = get_cache_files(data_file, cache_dir=cache_dir)
+
+    if not all(x.exists() for x in cache_files.values()):
+        return None
+
+    with open(cache_files["manifest"], "r") as stream:
+        manifest = json.load(stream)
+
+    source_stat = data_file.stat()
+    if (
+        manifest["source_mtime"] != source_stat.st_mtime
+        or manifest["source_size"] != source_stat.st_size
+    ):
+        return None
+
+    if check_hash and manifest["source_md5"] != get_file_hash(data_file):
+        return None
+
+    return manifest
 
+
+def load_split(data_file, use_cache=True, cache_dir=default_cache_dir, check_hash=False):
+    """
+    Load the features and metadata of one single cell file
+
+    With use_cache=True, the gzipped tsv is converted once into a binary cache and
+    the feature matrix is memory mapped (copy-on-write) from it on every later call,
+    which lets concurrent processes share the same pages.
+    """
+    if not use_cache:
+        df = pd.read_csv(data_file, sep="\t")
+        cp_features = infer_cp_features(df)
+        return df.loc[:, cp_features], df.drop(cp_features, axis="columns")
+
+    manifest = load_manifest(data_file, cache_dir=cache_dir, check_hash=check_hash)
+    if manifest is None:
+        manifest = build_cache(data_file, cache_dir=cache_dir)
+
+    cache_files = get_cache_files(data_file, cache_dir=cache_dir)
+    x = np.load(cache_files["features"], mmap_mode="c")
+    x_df = pd.DataFrame(x, columns=manifest["features"], copy=False)
+    meta_df = pd.read_parquet(cache_files["meta"])
+
+    return x_df, meta_df
+
+
+def apply_row_order(x_df, row_order):
+    """
+    Materialize a row permutation of a feature frame with a single gather
+    """
+    return pd.DataFrame(x_df.to_numpy()[row_order], columns=x_df.columns, copy=False)
+
+
+def load_data(
+    return_meta=False,
+    shuffle_row_order=False,
+    holdout=False,
+    othertreatment=False,
+    use_cache=True,
+    cache_dir=default_cache_dir,
+    lazy_shuffle=False,
+    check_hash=False,
+):
+    """
+    Load single cell data splits into a dictionary of features ("x") and metadata
+
+    When shuffle_row_order=True, each split also stores the random permutation under
+    "row_order". With lazy_shuffle=True the permutation is only recorded, and the
+    data stay in file order (memory mapped, no copy); apply it where the order
+    matters, e.g. with apply_row_order() or ml_utils.get_row_order_folds().
+
+    With check_hash=True, cached splits are also checked against the md5 hash of
+    their source file, not only its modification time and size.
+    """
+    data_files = {
+        "train": pathlib.Path(data_dir, "single_cell_train.tsv.gz"),
+        "test": pathlib.Path(data_dir, "single_cell_test.tsv.gz"),
+    }
+    if holdout:
+        data_files["holdout"] = pathlib.Path(data_dir, "single_cell_holdout.tsv.gz")
     if othertreatment:
-        output_data_dict["othertreatment"] = {}
-        other_file = pathlib.Path("data", "single_cell_othertreatment.tsv.gz")
-        other_df = pd.read_csv(other_file, sep="\t")
-        if shuffle_row_order:
-            other_df = other_df.sample(frac=1).reset_index(drop=True)
+        data_files["othertreatment"] = pathlib.Path(
+            data_dir, "single_cell_othertreatment.tsv.gz"
+        )
 
-        output_data_dict["othertreatment"]["x"] = other_df.loc[:, cp_features]
+    output_data_dict = {}
+    cp_features = None
+    for data_split, data_file in data_files.items():
+        x_df, meta_df = load_split(
+            data_file, use_cache=use_cache, cache_dir=cache_dir, check_hash=check_hash
+        )
 
-    if return_meta:
-        output_data_dict["train"]["meta"] = train_df.drop(cp_features, axis="columns")
-        output_data_dict["test"]["meta"] = test_df.drop(cp_features, axis="columns")
+        # All data splits use the features of the training set
+        if cp_features is None:
+            cp_features = x_df.columns.tolist()
+        elif x_df.columns.tolist() != cp_features:
+            x_df = x_df.reindex(cp_features, axis="columns")
 
-        if holdout:
-            output_data_dict["holdout"]["meta"] = holdout_df.drop(cp_features, axis="columns")
+        output_data_dict[data_split] = {}
+        if shuffle_row_order:
+            row_order = np.random.permutation(x_df.shape[0])
+            output_data_dict[data_split]["row_order"] = row_order
+            if not lazy_shuffle:
+                x_df = apply_row_order(x_df, row_order)
+                meta_df = meta_df.take(row_order).reset_index(drop=True)
 
-        if othertreatment:
-            output_data_dict["othertreatment"]["meta"] = other_df.drop(cp_features, axis="columns")
+        output_data_dict[data_split]["x"] = x_df
+        if return_meta:
+            output_data_dict[data_split]["meta"] = meta_df
 
     return output_data_dict
@@ -1,52 +1,213 @@
+import sys
+import time
+import shutil
+import pathlib
+import tempfile
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
+from joblib import Parallel, delayed
+from scipy.stats import rankdata
 
-from sklearn.metrics import (
-    roc_auc_score,
-    roc_curve,
-    precision_recall_curve,
-    average_precision_score
-)
+from sklearn.base import clone
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import StratifiedKFold, check_cv
+from sklearn.utils import check_random_state
 
+# Curve helpers are shared with the bulk signature metrics (repository "scripts")
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2] / "scripts"))
+from curve_utils import downsample_curve
 
-def get_threshold_metrics(y_true, y_pred, drop_intermediate=False):
+
+def sort_threshold_counts(y_true, y_scores):
+    """
+    Sort prediction columns once and count true/false positives at every cut-off
+    Arguments:
+    y_true - a (samples,) array of gold standard status shared by all columns, or a
+             (samples, columns) array with one status per column
+    y_scores - a (samples, columns) array of predicted scores
+    Output:
+    sorted scores, cumulative true and false positive counts (all samples x columns),
+    and a boolean mask of the last sample of each distinct score (a curve threshold)
+    """
+    y_scores = np.asarray(y_scores, dtype=np.float64)
+    if y_scores.ndim == 1:
+        y_scores = y_scores[:, np.newaxis]
+    y_true = np.asarray(y_true, dtype=np.float64)
+    if y_true.ndim == 1:
+        y_true = np.broadcast_to(y_true[:, np.newaxis], y_scores.shape)
+
+    order = np.argsort(-y_scores, axis=0, kind="mergesort")
+    sorted_scores = np.take_along_axis(y_scores, order, axis=0)
+    tps = np.cumsum(np.take_along_axis(y_true, order, axis=0), axis=0)
+    fps = np.arange(1, y_scores.shape[0] + 1)[:, np.newaxis] - tps
+
+    threshold_mask = np.ones(y_scores.shape, dtype=bool)
+    threshold_mask[:-1] = sorted_scores[:-1] != sorted_scores[1:]
+
+    if np.any(tps[-1] == 0) or np.any(fps[-1] == 0):
+        raise ValueError(
+            "Only one class present in y_true. ROC AUC score is not defined in that case."
+        )
+
+    return sorted_scores, tps, fps, threshold_mask
+
+
+def threshold_curve_metrics(tps, fps, threshold_mask):
+    """
+    Compute auroc and average precision of every column from cumulative counts
+    Arguments:
+    tps, fps, threshold_mask - output of sort_threshold_counts()
+    Output:
+    arrays of AUROC and average precision, one value per column
+    """
+    # Counts at the previous threshold of each row, from a running max of row indices
+    sample_idx = np.arange(tps.shape[0])[:, np.newaxis]
+    threshold_idx = np.where(threshold_mask, sample_idx, -1)
+    previous_idx = np.full(tps.shape, -1)
+    previous_idx[1:] = np.maximum.accumulate(threshold_idx, axis=0)[:-1]
+
+    has_previous = previous_idx >= 0
+    previous_idx = previous_idx.clip(min=0)
+    previous_tps = np.where(has_previous, np.take_along_axis(tps, previous_idx, axis=0), 0)
+    previous_fps = np.where(has_previous, np.take_along_axis(fps, previous_idx, axis=0), 0)
+
+    n_pos = tps[-1]
+    n_neg = fps[-1]
+
+    # Trapezoidal area under the ROC curve and step-wise average precision
+    roc_area = (fps - previous_fps) * (tps + previous_tps)
+    auroc = np.where(threshold_mask, roc_area, 0).sum(axis=0) / (2 * n_pos * n_neg)
+
+    pr_area = (tps - previous_tps) * tps / (tps + fps)
+    avg_precision = np.where(threshold_mask, pr_area, 0).sum(axis=0) / n_pos
+
+    return auroc, avg_precision
+
+
+def threshold_curves(sorted_scores, tps, fps, drop_intermediate=False, max_points=None):
+    """
+    Build ROC and PR dataframes of a single column from cumulative counts
+    Arguments:
+    sorted_scores, tps, fps - one column of sort_threshold_counts() output, already
+                              restricted to the curve thresholds
+    drop_intermediate - boolean if suboptimal ROC thresholds should be dropped
+    max_points - the maximum number of points per curve (see downsample_curve())
+    Output:
+    pandas dataframes of ROC and PR data, matching roc_curve and precision_recall_curve
+    """
+    roc_tps, roc_fps, roc_thresh = tps, fps, sorted_scores
+    if drop_intermediate and len(fps) > 2:
+        optimal_idxs = np.where(
+            np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True]
+        )[0]
+        roc_tps = tps[optimal_idxs]
+        roc_fps = fps[optimal_idxs]
+        roc_thresh = sorted_scores[optimal_idxs]
+
+    roc_df = pd.DataFrame(
+        {
+            "fpr": np.r_[0, roc_fps] / roc_fps[-1],
+            "tpr": np.r_[0, roc_tps] / roc_tps[-1],
+            "threshold": np.r_[roc_thresh[0] + 1, roc_thresh],
+        }
+    )
+
+    # Precision recall curve stops once full recall is reached, from high to low cut-off
+    precision = tps / (tps + fps)
+    recall = tps / tps[-1]
+    last_ind = tps.searchsorted(tps[-1])
+    pr_slice = slice(last_ind, None, -1)
+    pr_df = pd.DataFrame(
+        {
+            "precision": np.r_[precision[pr_slice], 1],
+            "recall": np.r_[recall[pr_slice], 0],
+            "threshold": np.r_[sorted_scores[pr_slice], np.nan],
+        }
+    )
+
+    roc_df = downsample_curve(roc_df, "fpr", "tpr", max_points=max_points)
+    pr_df = downsample_curve(pr_df, "recall", "precision", max_points=max_points)
+
+    return roc_df, pr_df
+
+
+def get_threshold_metrics(y_true, y_pred, drop_intermediate=False, max_points=None):
     """
     Retrieve true/false positive rates and auroc/aupr for class predictions
     Arguments:
     y_true - an array of gold standard mutation status
     y_pred - an array of predicted mutation status
-    disease - a string that includes the corresponding TCGA study acronym
+    drop_intermediate - boolean if suboptimal ROC thresholds should be dropped
+    max_points - the maximum number of ROC and PR curve points, kept as a subset of
+                 the full curves (see downsample_curve()); AUROC and AUPR are always
+                 computed from the full curves, so the area under the returned curves
+                 may differ slightly from them
     Output:
-    dict of AUROC, AUPR, pandas dataframes of ROC and PR data, and cancer-type
+    dict of AUROC, AUPR, pandas dataframes of ROC and PR data
     """
+    sorted_scores, tps, fps, threshold_mask = sort_threshold_counts(y_true, y_pred)
+    auroc, avg_precision = threshold_curve_metrics(tps, fps, threshold_mask)
 
-    roc_columns = ['fpr', 'tpr', 'threshold']
-    roc_items = zip(
-        roc_columns,
-        roc_curve(y_true, y_pred, drop_intermediate=drop_intermediate)
-     )
-    roc_df = pd.DataFrame.from_dict(dict(roc_items))
-
-    pr_columns = ['precision', 'recall', 'threshold']
-    prec, rec, thresh = precision_recall_curve(y_true, y_pred)
-    pr_df = pd.DataFrame.from_records([prec, rec]).transpose()
-    pr_df = pd.concat([pr_df, pd.Series(thresh)], ignore_index=True, axis=1)
-    pr_df.columns = pr_columns
-
-    auroc = roc_auc_score(y_true, y_pred, average='weighted')
-    avg_precision = average_precision_score(y_true, y_pred, average='weighted')
+    threshold_mask = threshold_mask[:, 0]
+    roc_df, pr_df = threshold_curves(
+        sorted_scores[threshold_mask, 0],
+        tps[threshold_mask, 0],
+        fps[threshold_mask, 0],
+        drop_intermediate=drop_intermediate,
+        max_points=max_points,
+    )
 
     metric_dict = {
-        'auroc': auroc,
-        'average_precision': avg_precision,
+        'auroc': auroc[0],
+        'average_precision': avg_precision[0],
         'roc_df': roc_df,
         'pr_df': pr_df,
     }
     return metric_dict
 
 
+def get_threshold_metrics_batch(
+    y_true, y_scores, return_curves=True, drop_intermediate=False, max_points=None
+):
+    """
+    Retrieve auroc/aupr (and curves) for many prediction columns with a single sort
+    Arguments:
+    y_true - an array of gold standard status shared by all columns, or a dataframe
+             or array with one status column per score column (e.g. one-hot classes)
+    y_scores - a pandas dataframe of predicted scores, one column per class, shuffle
+               or split of the same samples
+    return_curves - boolean if ROC and PR dataframes should be built for each column
+    drop_intermediate - boolean if suboptimal ROC thresholds should be dropped
+    max_points - the maximum number of ROC and PR curve points per column
+    Output:
+    dict keyed by y_scores column of get_threshold_metrics() output dicts
+    """
+    sorted_scores, tps, fps, threshold_mask = sort_threshold_counts(y_true, y_scores)
+    aurocs, avg_precisions = threshold_curve_metrics(tps, fps, threshold_mask)
+
+    metric_dicts = {}
+    for column_idx, column in enumerate(y_scores.columns):
+        metric_dict = {
+            'auroc': aurocs[column_idx],
+            'average_precision': avg_precisions[column_idx],
+        }
+        if return_curves:
+            column_mask = threshold_mask[:, column_idx]
+            metric_dict['roc_df'], metric_dict['pr_df'] = threshold_curves(
+                sorted_scores[column_mask, column_idx],
+                tps[column_mask, column_idx],
+                fps[column_mask, column_idx],
+                drop_intermediate=drop_intermediate,
+                max_points=max_points,
+            )
+        metric_dicts[column] = metric_dict
+
+    return metric_dicts
+
+
 def shuffle_columns(feature):
     """
     To be used in an `apply` pandas func to shuffle columns around a datafame
@@ -55,6 +216,477 @@ def shuffle_columns(feature):
     return np.random.permutation(feature.tolist())
 
 
+def shuffle_columns_inplace(x, random_state=None):
+    """
+    Independently permute every column of a 2D numpy array in place
+
+    Each column is shuffled as a strided view, so no per-column copies or python
+    lists are built. With random_state=None the global numpy seed is used, which
+    draws the same permutations as applying `shuffle_columns` column by column.
+    """
+    random_state = check_random_state(random_state)
+    for column_idx in range(x.shape[1]):
+        random_state.shuffle(x[:, column_idx])
+    return x
+
+
+def get_row_order_folds(y, row_order, n_folds=5):
+    """
+    Build stratified cross validation folds as if rows were shuffled by row_order,
+    without reordering the data. Returns a list of (train, test) index arrays into
+    the unshuffled data, usable as the `cv` argument of a grid search.
+    """
+    y = np.asarray(y)
+    folds = StratifiedKFold(n_splits=n_folds).split(np.zeros(len(row_order)), y[row_order])
+    return [(row_order[train], row_order[test]) for train, test in folds]
+
+
+def fit_warm_start_path(
+    estimator,
+    x,
+    y,
+    train,
+    test,
+    cs,
+    l1_ratio,
+    scorer,
+    step_name="classify",
+    early_stopping_tol=0.05,
+    patience=2,
+    return_train_score=True,
+    resume=None,
+    n_cs=None,
+):
+    """
+    Fit one (l1_ratio, fold) regularization path, warm starting along increasing C
+
+    Returns a dictionary of per-C test/train scores and fit/score times, plus the
+    path estimator under "estimator". Once the test score has dropped more than
+    early_stopping_tol below the best score of the path for `patience` consecutive
+    values of C, the remaining values are not fit and are recorded as NaN.
+
+    Passing the results of an earlier call as `resume` continues that path from its
+    last fit C, without early stopping, up to the first `n_cs` values of C.
+    """
+    x_train, y_train = x[train], y[train]
+    x_test, y_test = x[test], y[test]
+
+    if resume is None:
+        path_estimator = clone(estimator).set_params(
+            **{f"{step_name}__l1_ratio": l1_ratio, f"{step_name}__warm_start": True}
+        )
+        path_results = {
+            key: np.full(len(cs), np.nan)
+            for key in ["test_score", "train_score", "fit_time", "score_time"]
+        }
+        start_idx = 0
+    else:
+        path_estimator = resume["estimator"]
+        path_results = {
+            key: value.copy() for key, value in resume.items() if key != "estimator"
+        }
+        start_idx = int(np.sum(~np.isnan(path_results["fit_time"])))
+        patience = np.inf
+
+    best_score = -np.inf
+    misses = 0
+    for c_idx in range(start_idx, len(cs) if n_cs is None else n_cs):
+        c = cs[c_idx]
+        path_estimator.set_params(**{f"{step_name}__C": c})
+
+        start_time = time.time()
+        path_estimator.fit(x_train, y_train)
+        path_results["fit_time"][c_idx] = time.time() - start_time
+
+        start_time = time.time()
+        test_score = scorer(path_estimator, x_test, y_test)
+        path_results["score_time"][c_idx] = time.time() - start_time
+        path_results["test_score"][c_idx] = test_score
+
+        if return_train_score:
+            path_results["train_score"][c_idx] = scorer(path_estimator, x_train, y_train)
+
+        # Stop following paths that are no longer competitive
+        if test_score < best_score - early_stopping_tol:
+            misses += 1
+        else:
+            misses = 0
+        best_score = max(best_score, test_score)
+        if misses >= patience:
+            break
+
+    path_results["estimator"] = path_estimator
+    return path_results
+
+
+class WarmStartPathSearchCV:
+    """
+    Elastic net grid search over C and l1_ratio that warm starts along C
+
+    Instead of fitting every (C, l1_ratio, fold) combination from scratch, a single
+    classifier per (l1_ratio, fold) is refit along increasing C, each fit starting
+    from the previous coefficients (see `fit_warm_start_path`). After fitting, the
+    object exposes `cv_results_`, `best_params_`, `best_score_`, `best_index_` and
+    `best_estimator_` in the same form as sklearn's GridSearchCV, so it can be passed
+    to `cross_validation_performance` and `output_coefficients`.
+
+    Early stopping only drops a value of C once the paths of every fold have
+    stopped before it: folds that stopped earlier are resumed up to the last C fit
+    by any fold, so each mean test score covers all folds, as in GridSearchCV.
+    Values of C dropped for every fold are ranked last.
+    """
+
+    def __init__(
+        self,
+        estimator,
+        cs,
+        l1_ratios,
+        cv=5,
+        scoring=None,
+        step_name="classify",
+        n_jobs=None,
+        early_stopping_tol=0.05,
+        patience=2,
+        return_train_score=True,
+    ):
+        self.estimator = estimator
+        self.cs = cs
+        self.l1_ratios = l1_ratios
+        self.cv = cv
+        self.scoring = scoring
+        self.step_name = step_name
+        self.n_jobs = n_jobs
+        self.early_stopping_tol = early_stopping_tol
+        self.patience = patience
+        self.return_train_score = return_train_score
+
+    def fit_path(self, x, y, train, test, l1_ratio):
+        return fit_warm_start_path(
+            estimator=self.estimator,
+            x=x,
+            y=y,
+            train=train,
+            test=test,
+            cs=sorted(self.cs),
+            l1_ratio=l1_ratio,
+            scorer=check_scoring(self.estimator, scoring=self.scoring),
+            step_name=self.step_name,
+            early_stopping_tol=self.early_stopping_tol,
+            patience=self.patience,
+            return_train_score=self.return_train_score,
+        )
+
+    def resume_path(self, x, y, train, test, l1_ratio, path_results, n_cs):
+        return fit_warm_start_path(
+            estimator=self.estimator,
+            x=x,
+            y=y,
+            train=train,
+            test=test,
+            cs=sorted(self.cs),
+            l1_ratio=l1_ratio,
+            scorer=check_scoring(self.estimator, scoring=self.scoring),
+            step_name=self.step_name,
+            return_train_score=self.return_train_score,
+            resume=path_results,
+            n_cs=n_cs,
+        )
+
+    def fit(self, X, y):
+        fit_path_searches({"search": (self, X)}, y, n_jobs=self.n_jobs)
+        return self
+
+    def set_results(self, path_results, n_folds):
+        """
+        Assemble per-path results into a GridSearchCV-style `cv_results_`
+        """
+        c_step = f"{self.step_name}__C"
+        l1_step = f"{self.step_name}__l1_ratio"
+        path_cs = sorted(self.cs)
+
+        # Candidates follow sklearn's ParameterGrid order
+        params = [{c_step: c, l1_step: l1} for c in self.cs for l1 in self.l1_ratios]
+
+        score_keys = ["test_score", "fit_time", "score_time"]
+        if self.return_train_score:
+            score_keys.append("train_score")
+
+        split_results = {
+            key: np.full((len(params), n_folds), np.nan) for key in score_keys
+        }
+        for param_idx, param in enumerate(params):
+            c_idx = path_cs.index(param[c_step])
+            for fold_idx in range(n_folds):
+                fold_result = path_results[(param[l1_step], fold_idx)]
+                for key in score_keys:
+                    split_results[key][param_idx, fold_idx] = fold_result[key][c_idx]
+
+        cv_results = {
+            "mean_fit_time": np.nanmean(split_results["fit_time"], axis=1),
+            "std_fit_time": np.nanstd(split_results["fit_time"], axis=1),
+            "mean_score_time": np.nanmean(split_results["score_time"], axis=1),
+            "std_score_time": np.nanstd(split_results["score_time"], axis=1),
+            f"param_{c_step}": np.ma.MaskedArray([x[c_step] for x in params], dtype=object),
+            f"param_{l1_step}": np.ma.MaskedArray([x[l1_step] for x in params], dtype=object),
+            "params": params,
+        }
+
+        for score_key, score_name in [("test_score", "test"), ("train_score", "train")]:
+            if score_key not in split_results:
+                continue
+            scores = split_results[score_key]
+            for fold_idx in range(n_folds):
+                cv_results[f"split{fold_idx}_{score_name}_score"] = scores[:, fold_idx]
+            cv_results[f"mean_{score_name}_score"] = scores.mean(axis=1)
+            cv_results[f"std_{score_name}_score"] = scores.std(axis=1)
+
+        # Candidates dropped by early stopping on every fold are ranked last
+        mean_test_score = np.nan_to_num(cv_results["mean_test_score"], nan=-np.inf)
+        cv_results["rank_test_score"] = rankdata(-mean_test_score, method="min").astype(int)
+
+        self.cv_results_ = cv_results
+        self.best_index_ = int(np.argmin(cv_results["rank_test_score"]))
+        self.best_params_ = params[self.best_index_]
+        self.best_score_ = cv_results["mean_test_score"][self.best_index_]
+        self.n_splits_ = n_folds
+        return self
+
+    def refit(self, x, y):
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+        self.best_estimator_.fit(x, y)
+        return self
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+    def decision_function(self, X):
+        return self.best_estimator_.decision_function(X)
+
+
+def get_backing_memmap(x):
+    """
+    Return the file backed np.memmap that an array is a view of, or None
+    """
+    while x is not None:
+        if isinstance(x, np.memmap) and x.filename is not None:
+            return x
+        x = getattr(x, "base", None)
+    return None
+
+
+def fit_path_searches(searches, y, n_jobs=-1, memmap_dir=None):
+    """
+    Fit several WarmStartPathSearchCV objects on shared data in one worker pool
+
+    Arguments:
+    searches - a dictionary of name: (search, x), e.g. the real and the shuffled
+        searches with their feature matrices. All searches must use the same `cv`.
+    y - the class labels shared by all searches
+    n_jobs - number of workers for the single pool that runs every path
+    memmap_dir - where the float32 feature matrices are written; a temporary
+        directory (removed afterwards) is used by default
+
+    Each feature matrix is written once as a float32 .npy file and memory mapped
+    read-only, so workers receive a file reference rather than a pickled copy of the
+    data. float32 matrices (or DataFrames) that are views of a memory mapped file,
+    e.g. from load_data(use_cache=True), are shared as is. Folds are computed once and shared by all searches, and the paths of all
+    searches are scheduled together before the best models are refit.
+    """
+    cleanup = memmap_dir is None
+    if cleanup:
+        memmap_dir = tempfile.mkdtemp(prefix="path_search_")
+    pathlib.Path(memmap_dir).mkdir(parents=True, exist_ok=True)
+
+    y = np.asarray(y)
+    x_memmaps = {}
+    for name, (search, x) in searches.items():
+        if isinstance(x, pd.DataFrame):
+            x = x.to_numpy()
+        if x.dtype == np.float32 and get_backing_memmap(x) is not None:
+            x_memmaps[name] = x
+            continue
+        x_file = pathlib.Path(memmap_dir, f"{name}_x.npy")
+        np.save(x_file, np.asarray(x, dtype=np.float32))
+        x_memmaps[name] = np.load(x_file, mmap_mode="r")
+
+    cv = next(iter(searches.values()))[0].cv
+    folds = list(check_cv(cv, y, classifier=True).split(np.zeros(len(y)), y))
+
+    tasks = [
+        (name, l1_ratio, fold_idx)
+        for name, (search, x) in searches.items()
+        for l1_ratio in search.l1_ratios
+        for fold_idx in range(len(folds))
+    ]
+
+    with Parallel(n_jobs=n_jobs) as parallel:
+        path_results = parallel(
+            delayed(searches[name][0].fit_path)(
+                x_memmaps[name], y, folds[fold_idx][0], folds[fold_idx][1], l1_ratio
+            )
+            for name, l1_ratio, fold_idx in tasks
+        )
+        path_results = dict(zip(tasks, path_results))
+
+        # Resume folds that stopped before another fold of the same path
+        n_fit = {
+            task: int(np.sum(~np.isnan(result["fit_time"])))
+            for task, result in path_results.items()
+        }
+        n_path_cs = {}
+        for (name, l1_ratio, fold_idx), fold_n_fit in n_fit.items():
+            n_path_cs[(name, l1_ratio)] = max(
+                n_path_cs.get((name, l1_ratio), 0), fold_n_fit
+            )
+        resume_tasks = [task for task in tasks if n_fit[task] < n_path_cs[task[:2]]]
+        resumed_results = parallel(
+            delayed(searches[name][0].resume_path)(
+                x_memmaps[name],
+                y,
+                folds[fold_idx][0],
+                folds[fold_idx][1],
+                l1_ratio,
+                path_results[(name, l1_ratio, fold_idx)],
+                n_path_cs[(name, l1_ratio)],
+            )
+            for name, l1_ratio, fold_idx in resume_tasks
+        )
+        path_results.update(zip(resume_tasks, resumed_results))
+
+        for name, (search, x) in searches.items():
+            search_results = {
+                (l1_ratio, fold_idx): result
+                for (task_name, l1_ratio, fold_idx), result in path_results.items()
+                if task_name == name
+            }
+            search.set_results(search_results, n_folds=len(folds))
+
+        best_estimators = parallel(
+            delayed(search.refit)(x_memmaps[name], y)
+            for name, (search, x) in searches.items()
+        )
+
+    for name, best_search in zip(searches, best_estimators):
+        searches[name][0].best_estimator_ = best_search.best_estimator_
+
+    del x_memmaps
+    if cleanup:
+        shutil.rmtree(memmap_dir, ignore_errors=True)
+
+    return {name: search for name, (search, x) in searches.items()}
+
+
+def iterate_balanced_batches(y, batch_size, random_state=None):
+    """
+    Yield index arrays of class balanced mini batches that make up one epoch
+
+    Every batch holds batch_size // n_classes cells of each class. An epoch lasts
+    until the largest class has been seen once, cycling through smaller classes.
+    Indices are sorted within a batch so reads from memory mapped data stay local.
+    """
+    random_state = check_random_state(random_state)
+    y = np.asarray(y)
+    classes = np.unique(y)
+    class_idx = [random_state.permutation(np.flatnonzero(y == x)) for x in classes]
+
+    per_class = max(1, batch_size // len(classes))
+    n_batches = int(np.ceil(max(len(x) for x in class_idx) / per_class))
+    for batch_idx in range(n_batches):
+        batch_positions = np.arange(batch_idx * per_class, (batch_idx + 1) * per_class)
+        batch = np.concatenate(
+            [np.take(x, batch_positions, mode="wrap") for x in class_idx]
+        )
+        yield np.sort(batch)
+
+
+def predict_proba_chunked(model, x, chunk_size=100000):
+    return np.concatenate(
+        [
+            model.predict_proba(x[start : start + chunk_size])
+            for start in range(0, x.shape[0], chunk_size)
+        ]
+    )
+
+
+def train_streaming_classifier(
+    x,
+    y,
+    classifier=None,
+    batch_size=10000,
+    n_epochs=5,
+    eval_x=None,
+    eval_y=None,
+    eval_every=10,
+    random_state=None,
+):
+    """
+    Train a classifier out-of-core with partial_fit over class balanced mini batches
+
+    Arguments:
+    x - feature matrix; a memory mapped array (e.g. from the single cell cache in
+        data_utils.load_split) is read one mini batch at a time
+    y - class labels
+    classifier - any estimator with partial_fit and predict_proba; defaults to a
+        logistic elastic net SGDClassifier
+    batch_size - cells per mini batch (split evenly across classes)
+    n_epochs - passes over the largest class
+    eval_x, eval_y - held-out data scored every eval_every batches and at the end
+        of each epoch, one class versus rest, with get_threshold_metrics_batch
+    random_state - seed for the batch order
+
+    Output:
+    the trained classifier and a dataframe of held-out auroc and average precision
+    per class over training
+    """
+    random_state = check_random_state(random_state)
+    y = np.asarray(y)
+    classes = np.unique(y)
+
+    if classifier is None:
+        classifier = SGDClassifier(
+            loss="log", penalty="elasticnet", alpha=0.001, l1_ratio=0.15, random_state=0
+        )
+
+    eval_results = []
+
+    def evaluate_classifier(epoch, n_batches_seen):
+        eval_scores = pd.DataFrame(
+            predict_proba_chunked(classifier, eval_x, chunk_size=batch_size),
+            columns=classifier.classes_,
+        )
+        eval_onehot = np.asarray(eval_y)[:, np.newaxis] == classifier.classes_
+        batch_metrics = get_threshold_metrics_batch(
+            eval_onehot, eval_scores, return_curves=False
+        )
+        for class_label, metrics in batch_metrics.items():
+            eval_results.append(
+                {
+                    "epoch": epoch,
+                    "batches_seen": n_batches_seen,
+                    "class": class_label,
+                    "auroc": metrics["auroc"],
+                    "average_precision": metrics["average_precision"],
+                }
+            )
+
+    n_batches_seen = 0
+    for epoch in range(n_epochs):
+        for batch in iterate_balanced_batches(y, batch_size, random_state=random_state):
+            classifier.partial_fit(np.asarray(x[batch]), y[batch], classes=classes)
+            n_batches_seen += 1
+
+            if eval_x is not None and n_batches_seen % eval_every == 0:
+                evaluate_classifier(epoch, n_batches_seen)
+
+        if eval_x is not None and n_batches_seen % eval_every != 0:
+            evaluate_classifier(epoch, n_batches_seen)
+
+    return classifier, pd.DataFrame(eval_results)
+
+
 def cross_validation_performance(trained_pipeline, output_file):
     # Cross-validated performance heatmap
     cv_results = (
@@ -110,3 +742,64 @@ def model_apply(model, x_df, meta_df, y_recode, data_fit, shuffled, predict_prob
         .merge(meta_df, left_index=True, right_index=True)
     ).assign(data_fit=data_fit, shuffled=shuffled)
     return scores_df
+
+
+def score_splits(models, data_dict, y_recode, chunk_size=100000, dtype=np.float64):
+    """
+    Score every data split with several models in one chunked pass
+
+    Arguments:
+    models - a dictionary of shuffled status: fitted model, e.g.
+        {False: real_model, True: shuffled_model}
+    data_dict - output of data_utils.load_data(return_meta=True)
+    y_recode - how to name the probability column of each model class
+    chunk_size - number of cells read and scored at a time
+    dtype - data type of the preallocated probability array; the default float64
+        keeps written scores identical to model_apply(), float32 halves the memory
+
+    Output:
+    A dataframe with one row per cell, split and model (ordered by split, then
+    model) holding class probabilities, metadata, data_fit and shuffled columns.
+    Probabilities are written into one preallocated array and the dataframe is
+    assembled column by column, without index merges.
+    """
+    classes = next(iter(models.values())).classes_
+    n_models = len(models)
+    n_cells = {data_fit: data_dict[data_fit]["x"].shape[0] for data_fit in data_dict}
+
+    scores = np.empty((sum(n_cells.values()) * n_models, len(classes)), dtype=dtype)
+
+    meta_columns = data_dict[next(iter(data_dict))]["meta"].columns.tolist()
+    meta_values = {x: [] for x in meta_columns}
+    data_fit_values = []
+    shuffled_values = []
+
+    offset = 0
+    for data_fit in data_dict:
+        x = data_dict[data_fit]["x"]
+        x = x.to_numpy() if isinstance(x, pd.DataFrame) else x
+        meta_df = data_dict[data_fit]["meta"].reindex(meta_columns, axis="columns")
+
+        for start in range(0, n_cells[data_fit], chunk_size):
+            x_chunk = x[start : start + chunk_size]
+            for model_idx, model in enumerate(models.values()):
+                model_offset = offset + model_idx * n_cells[data_fit] + start
+                scores[model_offset : model_offset + x_chunk.shape[0]] = (
+                    model.predict_proba(x_chunk)
+                )
+
+        for shuffled in models:
+            for meta_column in meta_columns:
+                meta_values[meta_column].append(meta_df[meta_column].to_numpy())
+            data_fit_values.append(np.repeat(data_fit, n_cells[data_fit]))
+            shuffled_values.append(np.repeat(shuffled, n_cells[data_fit]))
+
+        offset += n_cells[data_fit] * n_models
+
+    scores_df = {y_recode[x]: scores[:, class_idx] for class_idx, x in enumerate(classes)}
+    for meta_column in meta_columns:
+        scores_df[meta_column] = np.concatenate(meta_values[meta_column])
+    scores_df["data_fit"] = np.concatenate(data_fit_values)
+    scores_df["shuffled"] = np.concatenate(shuffled_values)
+
+    return pd.DataFrame(scores_df)
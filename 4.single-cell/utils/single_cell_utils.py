@@ -1,4 +1,7 @@
+import warnings
+import numpy as np
 import pandas as pd
+from joblib import dump, load
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import train_test_split
 
@@ -27,13 +30,136 @@ def filter_cells(df, drop_prop=0.1):
     return drop_cells
 
 
-def normalize_sc(sc_df, scaler_method="standard"):
+def fit_scaler_chunked(x, chunk_size=100000):
+    """
+    Fit StandardScaler statistics with partial_fit over row chunks of a 2D array
+    """
+    scaler = StandardScaler()
+    for start in range(0, x.shape[0], chunk_size):
+        scaler.partial_fit(x[start : start + chunk_size])
+    return scaler
+
+
+def transform_chunked(x, scaler, chunk_size=100000):
+    """
+    Standardize a float32 2D array in place, one chunk of rows at a time
+    """
+    mean = scaler.mean_.astype(x.dtype)
+    scale = scaler.scale_.astype(x.dtype)
+    for start in range(0, x.shape[0], chunk_size):
+        chunk = x[start : start + chunk_size]
+        chunk -= mean
+        chunk /= scale
+    return x
+
+
+def fit_normalizer(sc_df, scaler_method="standard", chunk_size=100000, control_query=None):
+    """
+    Fit a normalizer once so it can be saved and applied to any later single cell set
+
+    The returned dictionary stores the fitted scaler alongside the features it was
+    fit on. Provide a control_query (e.g. "Metadata_treatment == '0.1% DMSO'") to fit
+    the scaler statistics on a control population only. Once feature selection is
+    done, store the selected features with set_selected_features() so normalize_sc()
+    subsets any later set to them.
+    """
+    if scaler_method != "standard":
+        raise ValueError(f"scaler_method '{scaler_method}' is not supported")
+
+    if control_query is not None:
+        sc_df = sc_df.query(control_query)
+        if sc_df.shape[0] == 0:
+            raise ValueError(f"control_query '{control_query}' does not match any cells")
+
+    cp_features = infer_cp_features(sc_df)
+    scaler = StandardScaler()
+
+    for start in range(0, sc_df.shape[0], chunk_size):
+        scaler.partial_fit(
+            sc_df.iloc[start : start + chunk_size]
+            .loc[:, cp_features]
+            .to_numpy(dtype=np.float32)
+        )
+
+    normalizer = {
+        "scaler_method": scaler_method,
+        "control_query": control_query,
+        "features": cp_features,
+        "scaler": scaler,
+        "selected_features": None,
+    }
+    return normalizer
+
+
+def set_selected_features(normalizer, selected_features):
+    normalizer["selected_features"] = list(selected_features)
+    return normalizer
+
+
+def save_normalizer(normalizer, output_file):
+    dump(normalizer, output_file)
+
+
+def load_normalizer(normalizer_file):
+    return load(normalizer_file)
+
+
+def normalize_sc(sc_df, scaler_method="standard", chunk_size=None, normalizer=None):
     sc_df = sc_df.reset_index(drop=True)
     cp_features = infer_cp_features(sc_df)
     meta_df = sc_df.drop(cp_features, axis="columns")
+    if normalizer is not None:
+        fit_features = set(normalizer["features"])
+        sc_features = set(cp_features)
+        missing_features = [x for x in normalizer["features"] if x not in sc_features]
+        if len(missing_features) > 0:
+            raise ValueError(
+                f"{len(missing_features)} normalizer features are missing, e.g. {missing_features[:5]}"
+            )
+        extra_features = [x for x in cp_features if x not in fit_features]
+        if len(extra_features) > 0:
+            warnings.warn(
+                f"Dropping {len(extra_features)} features the normalizer was not fit on"
+            )
+        cp_features = normalizer["features"]
+        if chunk_size is None:
+            chunk_size = 100000
     meta_df.columns = [
         x if x.startswith("Metadata_") else f"Metadata_{x}" for x in meta_df.columns
     ]
+
+    if chunk_size is not None:
+        # Streaming mode: features are copied chunk by chunk into a single
+        # preallocated float32 array, which is then scaled in place
+        x = np.empty((sc_df.shape[0], len(cp_features)), dtype=np.float32)
+        for start in range(0, sc_df.shape[0], chunk_size):
+            x[start : start + chunk_size] = (
+                sc_df.iloc[start : start + chunk_size]
+                .loc[:, cp_features]
+                .to_numpy(dtype=np.float32)
+            )
+        del sc_df
+
+        if normalizer is not None:
+            scaler = normalizer["scaler"]
+        elif scaler_method == "standard":
+            scaler = fit_scaler_chunked(x, chunk_size=chunk_size)
+
+        x = transform_chunked(x, scaler, chunk_size=chunk_size)
+
+        # Wrap the scaled array without copying it and reattach the metadata
+        # positionally (row order is unchanged)
+        sc_df = pd.DataFrame(x, index=meta_df.index, columns=cp_features, copy=False)
+        for position, meta_col in enumerate(meta_df.columns):
+            sc_df.insert(position, meta_col, meta_df[meta_col].to_numpy())
+
+        if normalizer is not None and normalizer.get("selected_features") is not None:
+            sc_df = sc_df.reindex(
+                meta_df.columns.tolist() + normalizer["selected_features"],
+                axis="columns",
+            )
+        return sc_df
+
     sc_df = sc_df.loc[:, cp_features]
 
     if scaler_method == "standard":
@@ -90,7 +216,8 @@ def process_sites(
     feature_filter,
     seed=123,
     scaler_method="standard",
-    normalize=True
+    normalize=True,
+    chunk_size=None,
 ):
     data_df = {}
     for imagenumber in imagenumbers:
@@ -105,6 +232,8 @@ def process_sites(
     data_df = pd.concat(data_df).reset_index(drop=True)
 
     if normalize:
-        data_df = normalize_sc(data_df, scaler_method=scaler_method)
+        data_df = normalize_sc(
+            data_df, scaler_method=scaler_method, chunk_size=chunk_size
+        )
 
     return data_df
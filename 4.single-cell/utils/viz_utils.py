@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import plotnine as gg
+
+
+def rasterize_points(df, x, y, color=None, facets=None, bins=400, x_range=None, y_range=None):
+    """
+    Aggregate a large scatter into a grid of bins, to draw a single tile per bin
+    instead of one marker per point
+    Arguments:
+    df - pandas dataframe of points
+    x, y - the coordinate columns
+    color - an optional column to color bins by: the most frequent category of each
+            bin for a categorical column, or the mean of each bin for a numeric one
+    facets - optional list of columns the plot is faceted by; bins are computed per
+             facet on a shared grid
+    bins - the number of bins along each axis
+    x_range, y_range - optional (min, max) limits of the grid; default to the data range
+    Output:
+    pandas dataframe of the nonempty bins with their center (x, y), point count,
+    density (log count scaled to [0, 1]), the color value, and the facet columns;
+    points with missing or infinite coordinates are dropped
+    """
+    if facets is None:
+        facets = []
+
+    is_finite = np.isfinite(df.loc[:, x].to_numpy(dtype=np.float64)) & np.isfinite(
+        df.loc[:, y].to_numpy(dtype=np.float64)
+    )
+    if not is_finite.all():
+        df = df.loc[is_finite]
+
+    x_values = df.loc[:, x].to_numpy(dtype=np.float64)
+    y_values = df.loc[:, y].to_numpy(dtype=np.float64)
+    if x_range is None:
+        x_range = (np.nanmin(x_values), np.nanmax(x_values))
+    if y_range is None:
+        y_range = (np.nanmin(y_values), np.nanmax(y_values))
+
+    x_width = (x_range[1] - x_range[0]) / bins or 1.0
+    y_width = (y_range[1] - y_range[0]) / bins or 1.0
+    x_bin = np.clip(((x_values - x_range[0]) // x_width).astype(np.int64), 0, bins - 1)
+    y_bin = np.clip(((y_values - y_range[0]) // y_width).astype(np.int64), 0, bins - 1)
+
+    if len(facets) > 0:
+        facet_codes = df.groupby(facets, sort=False).ngroup().to_numpy()
+    else:
+        facet_codes = np.zeros(df.shape[0], dtype=np.int64)
+    bin_codes = (facet_codes * bins + x_bin) * bins + y_bin
+
+    bin_df = pd.DataFrame({"bin": bin_codes, "row": np.arange(df.shape[0])})
+    if color is None:
+        tile_df = bin_df.groupby("bin").agg(count=("row", "size"), row=("row", "first"))
+    elif pd.api.types.is_numeric_dtype(df.loc[:, color]):
+        bin_df = bin_df.assign(color=df.loc[:, color].to_numpy())
+        tile_df = bin_df.groupby("bin").agg(
+            count=("row", "size"), row=("row", "first"), color=("color", "mean")
+        )
+    else:
+        # Keep the most frequent category of each bin
+        color_codes, color_categories = pd.factorize(df.loc[:, color], sort=True)
+        bin_df = bin_df.assign(color=color_codes)
+        category_df = (
+            bin_df.groupby(["bin", "color"])
+            .agg(category_count=("row", "size"), row=("row", "first"))
+            .reset_index()
+            .sort_values(["bin", "category_count"], ascending=[True, False], kind="mergesort")
+        )
+        tile_df = category_df.drop_duplicates("bin").set_index("bin")
+        tile_df = tile_df.assign(
+            count=category_df.groupby("bin").category_count.sum(),
+            color=color_categories.take(tile_df.color.to_numpy()),
+        )
+
+    bin_index = tile_df.index.to_numpy()
+    log_count = np.log1p(tile_df.loc[:, "count"].to_numpy())
+    output_df = pd.DataFrame(
+        {
+            x: x_range[0] + ((bin_index // bins) % bins + 0.5) * x_width,
+            y: y_range[0] + (bin_index % bins + 0.5) * y_width,
+            "count": tile_df.loc[:, "count"].to_numpy(),
+            "density": log_count / log_count.max(),
+        }
+    )
+    if color is not None:
+        output_df[color] = tile_df.loc[:, "color"].to_numpy()
+
+    # Facet values are taken from a representative point of each bin
+    rows = tile_df.loc[:, "row"].to_numpy()
+    for facet in facets:
+        output_df[facet] = df.loc[:, facet].to_numpy()[rows]
+
+    return output_df.assign(tile_width=x_width, tile_height=y_width)
+
+
+def geom_point_raster(
+    df, x, y, color=None, facets=None, bins=400, alpha_range=(0.3, 1), **tile_kwargs
+):
+    """
+    A plotnine replacement for geom_point on large scatters: points are rasterized
+    with rasterize_points() and drawn as tiles shaded by their log density
+    Arguments:
+    df, x, y, color, facets, bins - see rasterize_points()
+    alpha_range - the alpha of the least and most dense bins
+    tile_kwargs - any other geom_tile arguments
+    Output:
+    a list of plotnine layers to add to a ggplot(); bins are colored with the fill
+    aesthetic, so use fill scales (e.g. scale_fill_manual) for the color column
+    """
+    tile_df = rasterize_points(df, x=x, y=y, color=color, facets=facets, bins=bins)
+
+    mapping = {"x": x, "y": y, "alpha": "density"}
+    if color is not None:
+        mapping["fill"] = color
+
+    layers = [
+        gg.geom_tile(
+            gg.aes(**mapping),
+            data=tile_df,
+            width=tile_df.tile_width.iloc[0],
+            height=tile_df.tile_height.iloc[0],
+            **tile_kwargs
+        ),
+        gg.scale_alpha_continuous(range=alpha_range, guide=False),
+    ]
+    return layers
@@ -25,6 +25,8 @@
 import pathlib
 import pandas as pd
 
+from utils.singscore_utils import categorize_singscore_accuracy, summarize_singscore_accuracy
+
 
 # In[2]:
 
@@ -95,54 +97,8 @@ full_singscore_df = full_singscore_df.loc[
     ]
 ]
 
-all_pass_sign = []
-all_pass_permuted = []
-all_completely_incorrect = []  # Must pass oppositive permuted value
-for profile_idx, profile in full_singscore_df.iterrows():
-    if profile["Metadata_clone_type"] == "sensitive":
-        if profile["TotalScore"] < profile["min_permuted_value"]:
-            pass_sign = 1
-            pass_permuted = 1
-        else:
-            pass_permuted = 0
-            if profile["TotalScore"] < 0:
-                pass_sign = 1
-            else:
-                pass_sign = 0
-            
-        completely_incorrect = 0
-        if profile["TotalScore"] >= profile["max_permuted_value"]:
-            completely_incorrect = 1
-
-    if profile["Metadata_clone_type"] == "resistant":
-        if profile["TotalScore"] > profile["max_permuted_value"]:
-            pass_sign = 1
-            pass_permuted = 1
-        else:
-            pass_permuted = 0
-            if profile["TotalScore"] > 0:
-                pass_sign = 1
-            else:
-                pass_sign = 0
-
-        completely_incorrect = 0
-        if profile["TotalScore"] <= profile["min_permuted_value"]:
-            completely_incorrect = 1
-
-    all_pass_sign.append(pass_sign)
-    all_pass_permuted.append(pass_permuted)
-    all_completely_incorrect.append(completely_incorrect)
-    
-full_singscore_df = full_singscore_df.assign(
-    pass_sign = all_pass_sign,
-    pass_permuted = all_pass_permuted,
-    completely_incorrect = all_completely_incorrect
-)
-
-# Create a column indicating incorrect predictions
-full_singscore_df = full_singscore_df.assign(incorrect = full_singscore_df.pass_sign + full_singscore_df.pass_permuted)
-full_singscore_df.incorrect = ~(full_singscore_df.incorrect > 0)
-full_singscore_df.incorrect = full_singscore_df.incorrect.astype(int)
+# Categorize the prediction of every profile
+full_singscore_df = categorize_singscore_accuracy(full_singscore_df)
 
 # Recode many of the samples to the correct/consistent number
 clone_recode_dict = {
@@ -171,41 +127,9 @@ full_singscore_df.head()
 
 
 # Summary of completely incorrect samples
-all_sample_groups_df = (
-    full_singscore_df
-    .groupby(["Metadata_model_split", "Metadata_clone_number"])
-    ["completely_incorrect"]
-    .count()
-    .reset_index()
-    .rename(
-        columns={"completely_incorrect": "total_samples"}
-    )
-)
-
-confidently_incorrect_counts_df = (
-    full_singscore_df
-    .query("completely_incorrect == 1")
-    .groupby(["Metadata_model_split", "Metadata_clone_number"])
-    ["completely_incorrect"]
-    .sum()
-    .reset_index()
-)
-
-all_sample_groups_df = (
-    all_sample_groups_df.merge(
-        confidently_incorrect_counts_df,
-        on=["Metadata_model_split", "Metadata_clone_number"],
-        how="left"
-    )
-    .fillna(0)
-)
-
-all_sample_groups_df = (
-    all_sample_groups_df.assign(
-        proportion_completely_incorrect = all_sample_groups_df.completely_incorrect / all_sample_groups_df.total_samples
-    )
-    .sort_values("proportion_completely_incorrect", ascending=False)
-    .reset_index(drop=True)
+all_sample_groups_df = summarize_singscore_accuracy(
+    full_singscore_df,
+    groups=["Metadata_model_split", "Metadata_clone_number"]
 )
 
 all_sample_groups_df.head(10)
@@ -214,95 +138,10 @@ all_sample_groups_df.head(10)
 # In[5]:
 
 
-full_sample_summary_df = (
-    all_sample_groups_df
-    .groupby("Metadata_clone_number")
-    [["total_samples", "completely_incorrect"]]
-    .sum()
-    .reset_index()
-)
-
-full_sample_summary_df.head(5)
-
-
-# In[6]:
-
-
-high_confidence_summary_df = (
-    full_singscore_df
-    .groupby(["Metadata_clone_number"])
-    ["pass_permuted"]
-    .sum()
-    .reset_index()
-    .rename(
-        columns={"pass_permuted": "high_confidence"}
-    )
-)
-
-high_confidence_summary_df.head()
-
-
-# In[7]:
-
-
-correct_summary_df = (
-    full_singscore_df
-    .groupby(["Metadata_clone_number"])
-    ["pass_sign"]
-    .sum()
-    .reset_index()
-    .rename(
-        columns={"pass_sign": "accurate"}
-    )
-)
-
-correct_summary_df.head()
-
-
-# In[8]:
-
-
-incorrect_summary_df = (
-    full_singscore_df
-    .groupby(["Metadata_clone_number"])
-    ["incorrect"]
-    .sum()
-    .reset_index()
-)
-
-incorrect_summary_df.head()
-
-
-# In[9]:
-
-
-overall_summary_df = full_sample_summary_df.merge(
-    high_confidence_summary_df,
-    on="Metadata_clone_number"
-).merge(
-    correct_summary_df,
-    on="Metadata_clone_number"
-).merge(
-    incorrect_summary_df,
-    on="Metadata_clone_number"
-)
-
-overall_summary_df.head()
-
-
-# In[10]:
-
-
-# Calculate proportions
-overall_summary_df = (
-    overall_summary_df.assign(
-        prop_completely_incorrect = overall_summary_df.completely_incorrect / overall_summary_df.total_samples,
-        prop_high_confidence = overall_summary_df.high_confidence / overall_summary_df.total_samples,
-        prop_accurate = overall_summary_df.accurate / overall_summary_df.total_samples,
-        prop_inaccurate = overall_summary_df.incorrect / overall_summary_df.total_samples
-    )
-    .sort_values("prop_completely_incorrect", ascending=False)
-    .reset_index(drop=True)
+# Summarize all categories per clone
+overall_summary_df = summarize_singscore_accuracy(
+    full_singscore_df,
+    groups=["Metadata_clone_number"]
 )
 
 overall_summary_df.to_csv(output_singscore_summary_file, index=False, sep="\t")
@@ -0,0 +1,465 @@
+import sys
+import pathlib
+import numpy as np
+import pandas as pd
+
+from joblib import Parallel, delayed
+from scipy.special import gammaln
+from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score, pairwise_distances
+
+from typing import Dict, List, Tuple, Union
+
+from pycytominer.cyto_utils import infer_cp_features
+
+# Projections are shared with the other modules (repository "scripts")
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2] / "scripts"))
+from projection_utils import fit_projection, default_cache_dir
+
+
+def get_feature_space(
+        df: pd.DataFrame,
+        features: Union[str, List[str]],
+        pca_n_components: int,
+        cache_dir: Union[pathlib.Path, None] = default_cache_dir
+        ) -> np.ndarray:
+    """
+    Subset a dataframe to a feature space and transform it with PCA.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The input dataframe. Should include feature columns and metadata columns.
+    features : str or list of str
+        The names of the feature columns. If 'infer', all non-metadata columns are used.
+    pca_n_components : int
+        The number of principal components to use for PCA transformation.
+    cache_dir : pathlib.Path, optional
+        Where to persist the projection (see projection_utils.fit_projection). The
+        projection of the same data, features, and number of components is reused.
+
+    Returns
+    -------
+    np.ndarray
+        The PCA transformed profiles (samples x components).
+    """
+    if features == "infer":
+        metadata_cols = infer_cp_features(df, metadata=True)
+        subset_df = df.drop(metadata_cols, axis="columns")
+    else:
+        subset_df = df.loc[:, features]
+
+    # Transform data into PCA space to account for differential feature numbers influencing distance metrics
+    projection = fit_projection(subset_df, n_components=pca_n_components, cache_dir=cache_dir)
+    return projection["scores"]
+
+
+def get_contingency_counts(
+        labels: np.ndarray,
+        class_codes: np.ndarray,
+        n_classes: int
+        ) -> np.ndarray:
+    """
+    Count samples of every class in every cluster of every clustering solution at once.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Cluster labels (solutions x samples), e.g. one row per k.
+    class_codes : np.ndarray
+        Integer class codes (samples x class columns). Codes of different class columns
+        must not overlap, so that each column contributes its own classes. Negative
+        codes (missing classes) are not counted.
+    n_classes : int
+        The total number of class codes across all class columns.
+
+    Returns
+    -------
+    np.ndarray
+        Counts (solutions x clusters x classes), from a single bincount.
+    """
+    labels = np.atleast_2d(labels)
+    class_codes = np.asarray(class_codes).reshape(labels.shape[1], -1)
+    n_solutions = labels.shape[0]
+    n_clusters = labels.max() + 1
+
+    cell_index = (
+        (np.arange(n_solutions)[:, np.newaxis] * n_clusters + labels)[:, :, np.newaxis]
+        * n_classes
+        + class_codes[np.newaxis, :, :]
+    )
+    is_class = np.broadcast_to(class_codes[np.newaxis, :, :] >= 0, cell_index.shape)
+    counts = np.bincount(
+        cell_index[is_class], minlength=n_solutions * n_clusters * n_classes
+    )
+
+    return counts.reshape(n_solutions, n_clusters, n_classes)
+
+
+def hypergeom_log_pmf(
+        x: np.ndarray,
+        class_size: np.ndarray,
+        cluster_size: np.ndarray,
+        total: np.ndarray
+        ) -> np.ndarray:
+    """
+    Log probability of x in class samples in a cluster (tables x outcomes), given the
+    class size, cluster size, and total number of samples of each table.
+    """
+    class_size = class_size[:, np.newaxis]
+    cluster_size = cluster_size[:, np.newaxis]
+    total = total[:, np.newaxis]
+
+    def log_choose(n, k):
+        return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+    return (
+        log_choose(class_size, x)
+        + log_choose(total - class_size, cluster_size - x)
+        - log_choose(total, cluster_size)
+    )
+
+
+def fisher_exact_tables(
+        in_class_in_cluster: np.ndarray,
+        in_class_not_cluster: np.ndarray,
+        not_class_in_cluster: np.ndarray,
+        not_class_not_cluster: np.ndarray,
+        max_cells: int = 10000000
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized two-sided Fisher's exact test of many 2x2 contingency tables.
+
+    Follows the conventions of scipy.stats.fisher_exact: the odds ratio is NaN (and
+    the p value 1) if a row or column of the table is empty, and infinite if either
+    off-diagonal cell is zero. The p value sums the hypergeometric probabilities of all
+    tables with the same margins that are at most as likely as the observed table.
+
+    Parameters
+    ----------
+    in_class_in_cluster, in_class_not_cluster, not_class_in_cluster, not_class_not_cluster : np.ndarray
+        The four cells of each table, as arrays of the same shape.
+    max_cells : int, default 10000000
+        The maximum size of the (tables x outcomes) probability grid held in memory.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Odds ratios and p values, in the shape of the input arrays.
+    """
+    shape = np.shape(in_class_in_cluster)
+    a, b, c, d = [
+        np.asarray(x, dtype=np.float64).ravel()
+        for x in [
+            in_class_in_cluster,
+            in_class_not_cluster,
+            not_class_in_cluster,
+            not_class_not_cluster
+        ]
+    ]
+
+    class_size = a + b
+    cluster_size = a + c
+    total = a + b + c + d
+    empty_margin = (class_size == 0) | (c + d == 0) | (cluster_size == 0) | (b + d == 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        odds_ratio = np.where((b > 0) & (c > 0), a * d / (b * c), np.inf)
+    odds_ratio[empty_margin] = np.nan
+
+    # Sum the probabilities of all possible tables at most as likely as the observed one
+    p_value = np.ones(a.shape[0])
+    outcomes = np.arange(int(np.minimum(class_size, cluster_size).max(initial=0)) + 1)
+    chunk_size = max(1, max_cells // outcomes.shape[0])
+    for start in range(0, a.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        margins = (class_size[chunk], cluster_size[chunk], total[chunk])
+
+        lowest = np.maximum(0, cluster_size[chunk] - (total[chunk] - class_size[chunk]))
+        highest = np.minimum(class_size[chunk], cluster_size[chunk])
+        in_support = (
+            (outcomes >= lowest[:, np.newaxis]) & (outcomes <= highest[:, np.newaxis])
+        )
+
+        with np.errstate(invalid="ignore"):
+            outcome_log_pmf = hypergeom_log_pmf(outcomes[np.newaxis, :], *margins)
+        observed_log_pmf = hypergeom_log_pmf(a[chunk][:, np.newaxis], *margins)
+
+        as_extreme = in_support & (outcome_log_pmf <= observed_log_pmf + np.log1p(1e-7))
+        p_value[chunk] = np.where(as_extreme, np.exp(outcome_log_pmf), 0).sum(axis=1)
+
+    p_value = np.minimum(p_value, 1)
+    p_value[empty_margin] = 1
+
+    return odds_ratio.reshape(shape), p_value.reshape(shape)
+
+
+def get_cluster_enrichment(
+        labels: np.ndarray,
+        class_df: pd.DataFrame
+        ) -> pd.DataFrame:
+    """
+    Fisher's exact test of enrichment of every class in every cluster, for many
+    clustering solutions and class columns at once.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Cluster labels (solutions x samples), e.g. one row per k. Labels must be
+        integers starting at 0.
+    class_df : pd.DataFrame
+        One column per class to test (e.g. clone type, batch, treatment), with the
+        samples in the same order as labels. Samples with a missing class are left out
+        of the tables of that class column.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per solution, cluster, class column and class value with the columns
+        'solution', 'cluster', 'class_column', 'class_value', 'odds_ratio', and 'p_value'.
+        Empty clusters are dropped.
+    """
+    labels = np.atleast_2d(labels)
+
+    # Give the values of each class column their own range of codes
+    class_codes = []
+    class_info = []
+    n_classes = []
+    for class_column in class_df.columns:
+        codes, values = pd.factorize(class_df[class_column])
+        class_codes.append(np.where(codes >= 0, codes + sum(n_classes), -1))
+        class_info.extend([(class_column, value) for value in values])
+        n_classes.append(len(values))
+    class_codes = np.column_stack(class_codes)
+
+    counts = get_contingency_counts(labels, class_codes, n_classes=sum(n_classes))
+
+    # Cluster sizes and totals of each class column only count samples with a class
+    column_starts = np.cumsum([0] + n_classes[:-1])
+    cluster_size = np.repeat(
+        np.add.reduceat(counts, column_starts, axis=2), n_classes, axis=2
+    )
+    class_size = counts.sum(axis=1, keepdims=True)
+    n_samples = cluster_size.sum(axis=1, keepdims=True)
+
+    in_class_not_cluster = class_size - counts
+    not_class_in_cluster = cluster_size - counts
+    not_class_not_cluster = n_samples - counts - in_class_not_cluster - not_class_in_cluster
+
+    odds_ratio, p_value = fisher_exact_tables(
+        counts, in_class_not_cluster, not_class_in_cluster, not_class_not_cluster
+    )
+
+    solution, cluster, class_idx = np.indices(counts.shape).reshape(3, -1)
+    class_info = pd.DataFrame(class_info, columns=["class_column", "class_value"])
+    enrichment_df = pd.concat(
+        [
+            pd.DataFrame({"solution": solution, "cluster": cluster}),
+            class_info.iloc[class_idx].reset_index(drop=True),
+            pd.DataFrame({"odds_ratio": odds_ratio.ravel(), "p_value": p_value.ravel()})
+        ],
+        axis="columns"
+    )
+
+    # Drop clusters that do not exist in a solution (e.g. fewer clusters at low k)
+    n_solutions, n_clusters = counts.shape[:2]
+    cluster_counts = np.bincount(
+        (np.arange(n_solutions)[:, np.newaxis] * n_clusters + labels).ravel(),
+        minlength=n_solutions * n_clusters
+    )
+    is_cluster = np.repeat(cluster_counts > 0, sum(n_classes))
+    return enrichment_df.loc[is_cluster].reset_index(drop=True)
+
+
+def fit_kmeans(
+        x: np.ndarray,
+        k: int,
+        distances: Union[np.ndarray, None] = None,
+        silhouette_sample_size: Union[int, None] = None
+        ) -> Tuple[np.ndarray, float]:
+    """
+    Fit KMeans for one k and score the solution with the silhouette width.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The samples to cluster.
+    k : int
+        The number of clusters.
+    distances : np.ndarray, optional
+        Precomputed pairwise euclidean distances of x, reused for every k.
+    silhouette_sample_size : int, optional
+        If distances are not given, estimate the silhouette width from a random
+        subset of samples of this size. None computes it from all samples.
+
+    Returns
+    -------
+    tuple
+        Cluster labels and silhouette width.
+    """
+    kmeans = KMeans(n_clusters=k, random_state=0, n_init=20).fit(x)
+
+    if distances is not None:
+        silhouette_width = silhouette_score(distances, kmeans.labels_, metric="precomputed")
+    else:
+        silhouette_width = silhouette_score(
+            x, kmeans.labels_, sample_size=silhouette_sample_size, random_state=0
+        )
+
+    return kmeans.labels_, silhouette_width
+
+
+def perform_clustering_sweep(
+        feature_spaces: Dict[str, Tuple[pd.DataFrame, Union[str, List[str]]]],
+        pca_n_components: int,
+        class_column: str,
+        positive_class: Union[int, str],
+        low_k: int,
+        high_k: int,
+        silhouette_sample_size: Union[int, None] = None,
+        enrichment_columns: Union[List[str], None] = None,
+        return_enrichment: bool = False,
+        projection_cache_dir: Union[pathlib.Path, None] = default_cache_dir,
+        n_jobs: int = -1
+        ) -> Union[pd.DataFrame, Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Perform KMeans clustering for a range of k in several feature spaces and calculate:
+        1) Silhouette width of clustering solution
+        2) Enrichment of a class within clusters
+
+    Every (feature space, k) pair is fit as a separate job in one process pool.
+
+    Parameters
+    ----------
+    feature_spaces : dict
+        Feature category labels mapped to (dataframe, features) tuples. Each dataframe
+        should include the feature columns and the class column. Features may be
+        'infer' to use all non-metadata columns.
+    pca_n_components : int
+        The number of principal components to use for PCA transformation.
+    class_column : str
+        The name of the class column.
+    positive_class : int or str
+        The value in the class column that represents the "positive" class.
+    low_k : int
+        The lower bound for the range of k for KMeans clustering.
+    high_k : int
+        The upper bound for the range of k for KMeans clustering.
+    silhouette_sample_size : int, optional
+        If None (default), pairwise distances are computed once per feature space and
+        the exact silhouette width is calculated from them for every k. Otherwise, the
+        silhouette width is estimated from a random subset of this many samples, which
+        avoids the quadratic memory of the distance matrix for large datasets.
+    enrichment_columns : list of str, optional
+        Additional class columns (e.g. batch, treatment) to test for enrichment of each
+        of their values in every cluster, in the same pass as the class column.
+    return_enrichment : bool, default False
+        Whether to also return the per cluster enrichment of all class values.
+    projection_cache_dir : pathlib.Path, optional
+        Where to persist the PCA projection of each feature space. None only reuses
+        projections within the session.
+    n_jobs : int, default -1
+        The number of parallel jobs.
+
+    Returns
+    -------
+    pd.DataFrame
+        A dataframe with the results, ordered by feature space and k.
+        Columns are 'k', 'silhouette_width', 'average_enrichment', 'maximum_enrichment',
+        'average_p_value', and 'feature_category'.
+    pd.DataFrame, optional
+        If return_enrichment, the odds ratio and p value of every class value of the
+        class column and enrichment columns in every cluster (see get_cluster_enrichment).
+    """
+    pca_spaces = {}
+    distance_spaces = {}
+    for feature_category, (df, features) in feature_spaces.items():
+        pca_spaces[feature_category] = get_feature_space(
+            df, features, pca_n_components, cache_dir=projection_cache_dir
+        )
+
+        if silhouette_sample_size is None:
+            distance_spaces[feature_category] = pairwise_distances(pca_spaces[feature_category])
+        else:
+            distance_spaces[feature_category] = None
+
+    jobs = [
+        (feature_category, k)
+        for feature_category in feature_spaces
+        for k in range(low_k, high_k + 1)
+    ]
+
+    cluster_results = Parallel(n_jobs=n_jobs)(
+        delayed(fit_kmeans)(
+            pca_spaces[feature_category],
+            k,
+            distances=distance_spaces[feature_category],
+            silhouette_sample_size=silhouette_sample_size
+        )
+        for feature_category, k in jobs
+    )
+
+    # Test the enrichment of all clusters of all k in one pass per feature space
+    ks = list(range(low_k, high_k + 1))
+    if enrichment_columns is None:
+        enrichment_columns = []
+    test_columns = [class_column] + [x for x in enrichment_columns if x != class_column]
+    cluster_results = iter(cluster_results)
+
+    results = []
+    all_enrichment_dfs = []
+    for feature_category, (df, features) in feature_spaces.items():
+        labels, silhouette_widths = zip(*[next(cluster_results) for k in ks])
+
+        enrichment_df = get_cluster_enrichment(
+            np.vstack(labels), df.loc[:, test_columns].reset_index(drop=True)
+        )
+        enrichment_df = enrichment_df.assign(
+            k=np.array(ks)[enrichment_df.solution], feature_category=feature_category
+        ).drop(columns="solution")
+
+        positive_class_df = enrichment_df.loc[
+            (enrichment_df.class_column == class_column)
+            & (enrichment_df.class_value == positive_class)
+        ]
+        positive_class_summary_df = (
+            positive_class_df
+            .groupby("k")
+            .agg(
+                average_enrichment=("odds_ratio", "mean"),
+                maximum_enrichment=("odds_ratio", "max"),
+                average_p_value=("p_value", "mean")
+            )
+            .reindex(ks)
+        )
+
+        # Undefined odds ratios (empty table margins) propagate to the summaries
+        has_undefined = positive_class_df.odds_ratio.isna().groupby(positive_class_df.k).any()
+        positive_class_summary_df.loc[
+            has_undefined.reindex(ks, fill_value=False).values,
+            ["average_enrichment", "maximum_enrichment"]
+        ] = np.nan
+
+        results.append(
+            positive_class_summary_df
+            .reset_index()
+            .assign(silhouette_width=silhouette_widths, feature_category=feature_category)
+        )
+        all_enrichment_dfs.append(enrichment_df)
+
+    results = pd.concat(results, ignore_index=True).loc[
+        :,
+        [
+            "k",
+            "silhouette_width",
+            "average_enrichment",
+            "maximum_enrichment",
+            "average_p_value",
+            "feature_category"
+        ]
+    ]
+
+    if return_enrichment:
+        return results, pd.concat(all_enrichment_dfs, ignore_index=True)
+
+    return results
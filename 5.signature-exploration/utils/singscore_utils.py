@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+
+def categorize_singscore_accuracy(
+    singscore_df,
+    score_col="TotalScore",
+    min_permuted_col="min_permuted_value",
+    max_permuted_col="max_permuted_value",
+    clone_type_col="Metadata_clone_type",
+):
+    """Categorize the signature prediction of every profile
+
+    Parameters
+    ----------
+    singscore_df : pandas.DataFrame
+        singscore results with one row per profile (or cell)
+    score_col : str, optional
+        The signature score column. Defaults to "TotalScore".
+    min_permuted_col : str, optional
+        The minimum permuted singscore column. Defaults to "min_permuted_value".
+    max_permuted_col : str, optional
+        The maximum permuted singscore column. Defaults to "max_permuted_value".
+    clone_type_col : str, optional
+        The column of "sensitive" or "resistant" status. Defaults to
+        "Metadata_clone_type".
+
+    Returns
+    -------
+    pandas.DataFrame
+        A copy of singscore_df with integer indicator columns "pass_sign" (accurate),
+        "pass_permuted" (high confidence), "completely_incorrect" (beyond the permuted
+        singscore in the opposite direction) and "incorrect" (not accurate). Profiles of
+        any other clone type are not categorized and get zeros.
+    """
+    score = singscore_df[score_col].to_numpy()
+    min_permuted = singscore_df[min_permuted_col].to_numpy()
+    max_permuted = singscore_df[max_permuted_col].to_numpy()
+    clone_type = singscore_df[clone_type_col].to_numpy()
+
+    is_sensitive = clone_type == "sensitive"
+    is_resistant = clone_type == "resistant"
+
+    # Sensitive profiles should score low, resistant profiles should score high
+    pass_permuted = np.select(
+        [is_sensitive, is_resistant], [score < min_permuted, score > max_permuted], False
+    )
+    pass_sign = pass_permuted | np.select(
+        [is_sensitive, is_resistant], [score < 0, score > 0], False
+    )
+    completely_incorrect = np.select(
+        [is_sensitive, is_resistant], [score >= max_permuted, score <= min_permuted], False
+    )
+
+    singscore_df = singscore_df.assign(
+        pass_sign=pass_sign.astype(int),
+        pass_permuted=pass_permuted.astype(int),
+        completely_incorrect=completely_incorrect.astype(int),
+        incorrect=((is_sensitive | is_resistant) & ~pass_sign).astype(int),
+    )
+
+    return singscore_df
+
+
+def summarize_singscore_accuracy(singscore_df, groups=["Metadata_clone_number"]):
+    """Count and proportion of profiles per category for every group (e.g. clone)
+
+    Parameters
+    ----------
+    singscore_df : pandas.DataFrame
+        output of :py:func:`categorize_singscore_accuracy`
+    groups : list, optional
+        Metadata columns to summarize by. Defaults to ["Metadata_clone_number"].
+
+    Returns
+    -------
+    pandas.DataFrame
+        The total number of profiles and the number and proportion that are completely
+        incorrect, high confidence, accurate and inaccurate per group, sorted by the
+        proportion of completely incorrect profiles. The completely_incorrect count is
+        a float, as in the previously published summary tables.
+    """
+    summary_df = (
+        singscore_df.groupby(groups)
+        .agg(
+            total_samples=("completely_incorrect", "size"),
+            completely_incorrect=("completely_incorrect", "sum"),
+            high_confidence=("pass_permuted", "sum"),
+            accurate=("pass_sign", "sum"),
+            incorrect=("incorrect", "sum"),
+        )
+        .reset_index()
+        .astype({"completely_incorrect": float})
+    )
+
+    total = summary_df.total_samples
+    summary_df = (
+        summary_df.assign(
+            prop_completely_incorrect=summary_df.completely_incorrect / total,
+            prop_high_confidence=summary_df.high_confidence / total,
+            prop_accurate=summary_df.accurate / total,
+            prop_inaccurate=summary_df.incorrect / total,
+        )
+        .sort_values("prop_completely_incorrect", ascending=False)
+        .reset_index(drop=True)
+    )
+
+    return summary_df
@@ -0,0 +1,60 @@
+"""
+Shared helpers for ROC and precision recall curves of single cell and bulk models
+
+Usage:
+Import Only (add the repository "scripts" directory to sys.path)
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def downsample_curve(curve_df, x_column, y_column, max_points=1000):
+    """
+    Bound the number of points of a ROC or PR curve by keeping a subset of its points
+    Arguments:
+    curve_df - pandas dataframe of curve data with a threshold column (roc_df, pr_df)
+    x_column - the curve axis to place the grid on (fpr or recall)
+    y_column - the other curve axis (tpr or precision)
+    max_points - the maximum number of points to keep; None keeps the full curve
+    Output:
+    pandas dataframe of at most max_points original curve points in the input order
+
+    The x axis is split into evenly spaced grid cells and, for each cell, only the
+    first and last curve points inside it are kept, so every output point is a real
+    threshold. Points are only dropped within a cell, which bounds the change in the
+    trapezoid area under the curve by half the cell width times the total variation
+    of y_column (at most 1 / (max_points - 5) for a ROC curve).
+    """
+    if max_points is None or curve_df.shape[0] <= max_points:
+        return curve_df
+
+    # Work with an increasing x axis (precision recall curves are stored decreasing)
+    descending = curve_df[x_column].iloc[0] > curve_df[x_column].iloc[-1]
+    if descending:
+        curve_df = curve_df.iloc[::-1]
+
+    x = curve_df[x_column].to_numpy()
+
+    def get_kept_points(n_grid):
+        # Each grid point keeps the curve points on either side of it
+        grid = np.linspace(x[0], x[-1], n_grid)
+        right = np.searchsorted(x, grid, side="left")
+        return np.unique(np.r_[0, right - 1, right, x.shape[0] - 1].clip(0, x.shape[0] - 1))
+
+    # Use the finest grid whose kept points fit in max_points (at most two points
+    # are kept per grid point, so max_points // 2 - 1 grid points always fit)
+    low, high = max(max_points // 2 - 1, 2), max_points
+    while low < high:
+        mid = (low + high + 1) // 2
+        if get_kept_points(mid).shape[0] <= max_points:
+            low = mid
+        else:
+            high = mid - 1
+    keep = get_kept_points(low)
+
+    sampled_df = curve_df.iloc[keep]
+    if descending:
+        sampled_df = sampled_df.iloc[::-1]
+
+    return sampled_df.reset_index(drop=True)
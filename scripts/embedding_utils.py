@@ -0,0 +1,406 @@
+"""
+Fit UMAP models once on a reference set, persist them, and embed new data into the
+same space. Embeddings are cached by the hash of their input data, so re-running
+figure notebooks does not refit.
+
+For single cell scale data, the kNN graph can be built with a persisted approximate
+nearest neighbor index (pynndescent) on a stratified subsample, and the remaining
+cells projected with transform only (see benchmark_embedding()).
+
+Usage:
+Import Only (add the repository "scripts" directory to sys.path)
+"""
+
+import time
+import json
+import joblib
+import hashlib
+import pathlib
+import numpy as np
+import pandas as pd
+import umap
+from pynndescent import NNDescent
+from sklearn.manifold import trustworthiness
+
+from pycytominer.cyto_utils import infer_cp_features
+
+from projection_utils import get_data_hash
+
+default_cache_dir = pathlib.Path(".cache", "embeddings")
+
+# UMAP models, nearest neighbor indices, and embeddings fit (or loaded) in this
+# session, keyed by cache key
+model_cache = {}
+index_cache = {}
+embedding_cache = {}
+
+
+def get_model_key(data_hash, features, umap_kwargs):
+    key = json.dumps(
+        {
+            "data_hash": data_hash,
+            "features": [str(x) for x in features],
+            "umap_kwargs": umap_kwargs,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def get_index_key(data_hash, index_kwargs):
+    key = json.dumps(
+        {"data_hash": data_hash, "index_kwargs": index_kwargs}, sort_keys=True, default=str
+    )
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def get_embedding_key(model_key, data_hash):
+    return hashlib.md5(f"{model_key}_{data_hash}".encode()).hexdigest()
+
+
+def get_cache_file(cache_dir, key, suffix):
+    if cache_dir is None:
+        return None
+    return pathlib.Path(cache_dir, f"{key}{suffix}")
+
+
+def stratified_subsample(meta_df, strata, n_samples, random_state=123):
+    """
+    Sample rows in proportion to the size of each stratum (at least one per stratum)
+
+    Arguments:
+    meta_df - pandas dataframe of sample metadata
+    strata - the metadata column(s) defining the strata
+    n_samples - the approximate total number of rows to sample
+    random_state - random seed
+
+    Output:
+    sorted numpy array of the positional indices of the sampled rows
+    """
+    if n_samples >= meta_df.shape[0]:
+        return np.arange(meta_df.shape[0])
+
+    rng = np.random.RandomState(random_state)
+    fraction = n_samples / meta_df.shape[0]
+
+    sample_index = []
+    for stratum_index in meta_df.groupby(strata).indices.values():
+        n_stratum = max(1, int(round(fraction * len(stratum_index))))
+        sample_index.append(rng.choice(stratum_index, size=n_stratum, replace=False))
+
+    return np.sort(np.concatenate(sample_index))
+
+
+def build_knn_index(
+    feature_df,
+    n_neighbors=15,
+    metric="euclidean",
+    data_hash=None,
+    cache_dir=default_cache_dir,
+    random_state=123,
+    **index_kwargs
+):
+    """
+    Build an approximate nearest neighbor index of a feature space, or reuse a cached one
+
+    Arguments:
+    feature_df - pandas dataframe of features only (samples x features)
+    n_neighbors - the number of neighbors in the kNN graph
+    metric - the distance metric
+    data_hash - a hash identifying the data; defaults to get_data_hash(feature_df)
+    cache_dir - directory to persist indices in; None only caches in memory
+    random_state - random seed
+    index_kwargs - any other pynndescent.NNDescent arguments (e.g. n_trees, n_iters,
+                   low_memory, n_jobs)
+
+    Output:
+    The pynndescent.NNDescent index; its neighbor_graph holds the kNN graph
+    """
+    index_kwargs.update(n_neighbors=n_neighbors, metric=metric, random_state=random_state)
+    if data_hash is None:
+        data_hash = get_data_hash(feature_df)
+
+    index_key = get_index_key(data_hash, index_kwargs)
+    if index_key in index_cache:
+        return index_cache[index_key]
+
+    index_file = get_cache_file(cache_dir, index_key, "_index.joblib")
+    if index_file is not None and index_file.exists():
+        knn_index = joblib.load(index_file)
+    else:
+        knn_index = NNDescent(feature_df.to_numpy(dtype=np.float32), **index_kwargs)
+        if index_file is not None:
+            index_file.parent.mkdir(parents=True, exist_ok=True)
+            joblib.dump(knn_index, index_file)
+
+    knn_index.index_key_ = index_key
+    index_cache[index_key] = knn_index
+    return knn_index
+
+
+def get_umap_model(feature_df, knn_index=None, **umap_kwargs):
+    """
+    Fit a UMAP model, reusing the kNN graph of a prebuilt index if provided
+    """
+    if knn_index is not None:
+        knn_indices, knn_dists = knn_index.neighbor_graph
+        umap_kwargs["precomputed_knn"] = (knn_indices, knn_dists, knn_index)
+        umap_kwargs.setdefault("n_neighbors", knn_indices.shape[1])
+        umap_kwargs.setdefault("metric", knn_index.metric)
+
+    return umap.UMAP(**umap_kwargs).fit(feature_df)
+
+
+def fit_embedding(
+    feature_df,
+    data_hash=None,
+    knn_index=None,
+    cache_dir=default_cache_dir,
+    random_state=123,
+    **umap_kwargs
+):
+    """
+    Fit a UMAP model to a reference feature space, or reuse a cached one
+
+    Arguments:
+    feature_df - pandas dataframe of features only (samples x features)
+    data_hash - a hash identifying the data; defaults to get_data_hash(feature_df)
+    knn_index - an index from build_knn_index() of the same feature_df; the model
+                reuses its kNN graph instead of computing one
+    cache_dir - directory to persist models in; None only caches in memory
+    random_state - UMAP random seed
+    umap_kwargs - any other umap.UMAP arguments (e.g. n_neighbors, metric)
+
+    Output:
+    The fitted umap.UMAP model. The model keeps its kNN graph and search index, so
+    new samples can be embedded with transform_embedding(), and stores the
+    embedding of the reference samples in the embedding_ attribute.
+    """
+    umap_kwargs["random_state"] = random_state
+    if data_hash is None:
+        data_hash = get_data_hash(feature_df)
+
+    key_kwargs = dict(umap_kwargs)
+    if knn_index is not None:
+        key_kwargs["knn_index"] = knn_index.index_key_
+    model_key = get_model_key(data_hash, feature_df.columns, key_kwargs)
+    if model_key in model_cache:
+        return model_cache[model_key]
+
+    model_file = get_cache_file(cache_dir, model_key, ".joblib")
+    if model_file is not None and model_file.exists():
+        reducer = joblib.load(model_file)
+    else:
+        reducer = get_umap_model(feature_df, knn_index=knn_index, **umap_kwargs)
+        if model_file is not None:
+            model_file.parent.mkdir(parents=True, exist_ok=True)
+            joblib.dump(reducer, model_file)
+
+    reducer.model_key_ = model_key
+    reducer.reference_hash_ = data_hash
+    model_cache[model_key] = reducer
+    return reducer
+
+
+def transform_embedding(reducer, feature_df, data_hash=None, cache_dir=default_cache_dir):
+    """
+    Embed samples into the space of a fitted model, or reuse a cached embedding
+
+    Arguments:
+    reducer - a model fit with fit_embedding()
+    feature_df - pandas dataframe with the same features the model was fit on
+    data_hash - a hash identifying the data; defaults to get_data_hash(feature_df)
+    cache_dir - directory to persist embeddings in; None only caches in memory
+
+    Output:
+    numpy array of the embedding (samples x components)
+    """
+    if data_hash is None:
+        data_hash = get_data_hash(feature_df)
+
+    # The reference samples were already embedded while fitting
+    if data_hash == reducer.reference_hash_:
+        return reducer.embedding_
+
+    embedding_key = get_embedding_key(reducer.model_key_, data_hash)
+    if embedding_key in embedding_cache:
+        return embedding_cache[embedding_key]
+
+    embedding_file = get_cache_file(cache_dir, embedding_key, ".npy")
+    if embedding_file is not None and embedding_file.exists():
+        embedding = np.load(embedding_file)
+    else:
+        embedding = reducer.transform(feature_df)
+        if embedding_file is not None:
+            embedding_file.parent.mkdir(parents=True, exist_ok=True)
+            np.save(embedding_file, embedding)
+
+    embedding_cache[embedding_key] = embedding
+    return embedding
+
+
+def get_embedding_df(embedding, meta_df, columns=["x", "y"]):
+    """
+    Combine embedding coordinates with the sample metadata for plotting
+    """
+    embedding_df = pd.DataFrame(embedding, columns=columns)
+    embedding_df = embedding_df.merge(
+        meta_df.reset_index(drop=True), left_index=True, right_index=True
+    )
+    return embedding_df
+
+
+def process_umap(
+    data_df,
+    features="infer",
+    reference_df=None,
+    umap_category=None,
+    columns=["x", "y"],
+    cache_dir=default_cache_dir,
+    **umap_kwargs
+):
+    """
+    Apply UMAP to a profile dataframe and return the coordinates with the metadata
+
+    Arguments:
+    data_df - pandas dataframe of profiles with feature and metadata columns
+    features - the feature columns to embed; "infer" uses all CellProfiler features
+    reference_df - profiles to fit the model on; defaults to data_df itself. Use the
+                   same reference_df to embed several dataframes into the same space.
+    umap_category - if provided, added to the output in Metadata_umap_category
+    columns - names of the coordinate columns
+    cache_dir - directory to persist models and embeddings in
+    umap_kwargs - any other fit_embedding() arguments (e.g. random_state)
+
+    Output:
+    pandas dataframe of the embedding coordinates and the data_df metadata
+    """
+    metadata_cols = infer_cp_features(data_df, metadata=True)
+    if features == "infer":
+        features = data_df.drop(metadata_cols, axis="columns").columns.tolist()
+
+    if reference_df is None:
+        reference_df = data_df
+
+    reducer = fit_embedding(
+        reference_df.loc[:, features], cache_dir=cache_dir, **umap_kwargs
+    )
+    embedding = transform_embedding(
+        reducer, data_df.loc[:, features], cache_dir=cache_dir
+    )
+
+    embedding_df = get_embedding_df(
+        embedding, data_df.loc[:, metadata_cols], columns=columns
+    )
+    if umap_category is not None:
+        embedding_df = embedding_df.assign(Metadata_umap_category=umap_category)
+
+    return embedding_df
+
+
+def benchmark_embedding(
+    feature_df,
+    meta_df,
+    strata,
+    fit_sizes,
+    include_full=True,
+    n_evaluate=2000,
+    trust_neighbors=5,
+    random_state=123,
+    index_kwargs={},
+    **umap_kwargs
+):
+    """
+    Compare the time and quality of UMAP embeddings fit on stratified subsamples
+    (with an approximate nearest neighbor index) and transformed for the remaining
+    samples, against a standard fit on all samples. Nothing is cached.
+
+    Arguments:
+    feature_df - pandas dataframe of features only (samples x features)
+    meta_df - pandas dataframe of the sample metadata (same row order)
+    strata - the metadata column(s) to stratify subsamples by
+    fit_sizes - list of the number of samples to fit each subsampled model on
+    include_full - whether to also time umap.UMAP().fit_transform() on all samples
+    n_evaluate - the number of samples to compute trustworthiness on (it is
+                 quadratic in the number of samples)
+    trust_neighbors - the neighborhood size of the trustworthiness metric
+    random_state - random seed
+    index_kwargs - pynndescent.NNDescent arguments of the subsampled models
+    umap_kwargs - umap.UMAP arguments of all models
+
+    Output:
+    pandas dataframe with one row per model: the fit mode, number of fit samples,
+    index, fit, and transform times (seconds), and trustworthiness
+    """
+    n_samples = feature_df.shape[0]
+    evaluate_index = stratified_subsample(
+        meta_df, strata, n_evaluate, random_state=random_state
+    )
+    evaluate_x = feature_df.to_numpy(dtype=np.float32)[evaluate_index]
+
+    results = []
+    if include_full:
+        start = time.time()
+        embedding = umap.UMAP(random_state=random_state, **umap_kwargs).fit_transform(
+            feature_df
+        )
+        results.append(
+            {
+                "mode": "full",
+                "n_fit": n_samples,
+                "index_seconds": 0.0,
+                "fit_seconds": time.time() - start,
+                "transform_seconds": 0.0,
+                "trustworthiness": trustworthiness(
+                    evaluate_x, embedding[evaluate_index], n_neighbors=trust_neighbors
+                ),
+            }
+        )
+
+    for fit_size in fit_sizes:
+        fit_index = stratified_subsample(
+            meta_df, strata, fit_size, random_state=random_state
+        )
+        fit_df = feature_df.iloc[fit_index, :]
+
+        start = time.time()
+        knn_index = NNDescent(
+            fit_df.to_numpy(dtype=np.float32),
+            n_neighbors=umap_kwargs.get("n_neighbors", 15),
+            metric=umap_kwargs.get("metric", "euclidean"),
+            random_state=random_state,
+            **index_kwargs
+        )
+        index_seconds = time.time() - start
+
+        start = time.time()
+        reducer = get_umap_model(
+            fit_df, knn_index=knn_index, random_state=random_state, **umap_kwargs
+        )
+        fit_seconds = time.time() - start
+
+        start = time.time()
+        embedding = reducer.transform(feature_df)
+        transform_seconds = time.time() - start
+
+        results.append(
+            {
+                "mode": "subsample_ann",
+                "n_fit": len(fit_index),
+                "index_seconds": index_seconds,
+                "fit_seconds": fit_seconds,
+                "transform_seconds": transform_seconds,
+                "trustworthiness": trustworthiness(
+                    evaluate_x, embedding[evaluate_index], n_neighbors=trust_neighbors
+                ),
+            }
+        )
+
+    benchmark_df = pd.DataFrame(results)
+    benchmark_df = benchmark_df.assign(
+        total_seconds=benchmark_df.loc[
+            :, ["index_seconds", "fit_seconds", "transform_seconds"]
+        ].sum(axis="columns")
+    )
+    return benchmark_df
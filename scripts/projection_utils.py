@@ -0,0 +1,137 @@
+"""
+Fit, cache, and reuse principal component projections of profile feature spaces
+
+Usage:
+Import Only (add the repository "scripts" directory to sys.path)
+"""
+
+import json
+import hashlib
+import pathlib
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA
+
+default_cache_dir = pathlib.Path(".cache", "projections")
+
+# Projections fit (or loaded) in this session, keyed by projection key
+projection_cache = {}
+
+
+def get_data_hash(feature_df):
+    """
+    md5 hash of the feature names and values of a dataframe
+    """
+    data_hash = hashlib.md5()
+    data_hash.update(json.dumps([str(x) for x in feature_df.columns]).encode())
+    data_hash.update(np.ascontiguousarray(feature_df.to_numpy(dtype=np.float64)).tobytes())
+    return data_hash.hexdigest()
+
+
+def get_projection_method(n_samples, n_features, n_components):
+    """
+    Use a randomized truncated SVD for large matrices where only a few components are
+    kept (the same rule as PCA(svd_solver="auto")), and a full SVD otherwise
+    """
+    if max(n_samples, n_features) > 500 and n_components < 0.8 * min(n_samples, n_features):
+        return "randomized"
+    return "full"
+
+
+def get_projection_key(data_hash, features, n_components, method, random_state, pca_kwargs):
+    key = json.dumps(
+        {
+            "data_hash": data_hash,
+            "features": [str(x) for x in features],
+            "n_components": n_components,
+            "method": method,
+            "random_state": random_state,
+            "pca_kwargs": pca_kwargs,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def fit_projection(
+    feature_df,
+    n_components,
+    method="auto",
+    data_hash=None,
+    cache_dir=default_cache_dir,
+    random_state=0,
+    **pca_kwargs,
+):
+    """
+    Fit a PCA projection of a feature space, or reuse a cached one
+
+    Arguments:
+    feature_df - pandas dataframe of features only (samples x features)
+    n_components - the number of principal components
+    method - the PCA svd solver ("full", "randomized", "arpack"); "auto" chooses with
+             get_projection_method()
+    data_hash - a hash identifying the data (e.g. the md5 of the file the features
+                were loaded from); defaults to get_data_hash(feature_df)
+    cache_dir - directory to persist projections in; None only caches in memory
+    random_state - seed of the randomized solver
+    pca_kwargs - any other PCA solver options (e.g. iterated_power, tol)
+
+    Output:
+    dict of the component scores (samples x components), components, mean, explained
+    variance (and ratio), method, and cache key
+    """
+    features = feature_df.columns.tolist()
+    if method == "auto":
+        method = get_projection_method(feature_df.shape[0], len(features), n_components)
+    if data_hash is None:
+        data_hash = get_data_hash(feature_df)
+
+    key = get_projection_key(
+        data_hash, features, n_components, method, random_state, pca_kwargs
+    )
+    if key in projection_cache:
+        return projection_cache[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = pathlib.Path(cache_dir, f"{key}.npz")
+
+    if cache_file is not None and cache_file.exists():
+        with np.load(cache_file) as stored:
+            projection = {x: stored[x] for x in stored.files}
+        projection["method"] = str(projection["method"])
+        projection["key"] = str(projection["key"])
+    else:
+        pca = PCA(
+            n_components=n_components,
+            svd_solver=method,
+            random_state=random_state,
+            **pca_kwargs,
+        )
+        scores = pca.fit(feature_df).transform(feature_df)
+        projection = {
+            "scores": scores,
+            "components": pca.components_,
+            "mean": pca.mean_,
+            "explained_variance": pca.explained_variance_,
+            "explained_variance_ratio": pca.explained_variance_ratio_,
+            "method": method,
+            "key": key,
+        }
+
+        if cache_file is not None:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            np.savez(cache_file, **projection)
+
+    projection_cache[key] = projection
+    return projection
+
+
+def transform_projection(projection, feature_df):
+    """
+    Project new samples (with the same features) into a fitted projection
+    """
+    return (feature_df.to_numpy(dtype=np.float64) - projection["mean"]) @ projection[
+        "components"
+    ].T
@@ -0,0 +1,576 @@
+"""
+Blockwise pairwise profile similarity: Pearson correlations are computed one block
+of the similarity matrix at a time and aggregated into histograms and summary
+statistics per pair category, without materializing every pair. Percent strong,
+median replicate correlation, and grit are computed from one shared similarity
+matrix and integer coded groups. Shared by the profiling audit and the across batch
+comparisons.
+
+Usage:
+Import Only (add the repository "scripts" directory to sys.path)
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+
+comparison_categories = [
+    "same_batch_replicate",
+    "across_batch_replicate",
+    "same_batch_nonreplicate",
+    "across_batch_nonreplicate",
+]
+
+
+def get_group_codes(df, groups, missing_match=False):
+    """
+    Integer code of the combination of group columns of each profile. Unless
+    missing_match=True, profiles with a missing value in any group column get their
+    own code, so they never match another profile.
+    """
+    column_codes = np.column_stack(
+        [pd.factorize(df.loc[:, group])[0] for group in groups]
+    )
+    group_codes = np.unique(column_codes, axis=0, return_inverse=True)[1].reshape(-1)
+
+    if not missing_match:
+        missing = (column_codes < 0).any(axis=1)
+        group_codes[missing] = group_codes.max() + 1 + np.arange(missing.sum())
+    return group_codes
+
+
+def get_similarity_matrix(df, features, similarity_metric="pearson"):
+    """
+    Compute the sample by sample similarity matrix of the given profile features
+    once, as a numpy array
+    """
+    x = df.loc[:, features].to_numpy(dtype=np.float64)
+
+    if np.isnan(x).any():
+        # Use pairwise complete observations, as pandas does
+        return df.loc[:, features].transpose().corr(method=similarity_metric).to_numpy()
+
+    if similarity_metric == "spearman":
+        x = rankdata(x, axis=1)
+    elif similarity_metric != "pearson":
+        raise ValueError(f"similarity_metric '{similarity_metric}' is not supported")
+
+    return np.corrcoef(x)
+
+
+def get_upper_pairs(similarity_matrix):
+    """
+    Indices and similarities of each unique pair of samples (the upper triangle),
+    in the same order as cytominer_eval metric_melt(eval_metric="replicate_reproducibility")
+    """
+    pair_a, pair_b = np.triu_indices(similarity_matrix.shape[0], k=1)
+    similarity = similarity_matrix[pair_a, pair_b]
+
+    keep = ~np.isnan(similarity)
+    return pair_a[keep], pair_b[keep], similarity[keep]
+
+
+def get_percent_strong(similarity, replicate_mask, quantile=0.95):
+    """
+    Fraction of replicate pairs more similar than the given quantile of the non
+    replicate pair (null) distribution
+    Output:
+    the null cutoff and percent strong
+    """
+    cutoff = np.quantile(similarity[~replicate_mask], quantile)
+    percent_strong = np.mean(similarity[replicate_mask] > cutoff)
+    return cutoff, percent_strong
+
+
+def standardize_profiles(x):
+    """
+    Center and scale each profile to unit norm, so the dot product of two profiles
+    is their Pearson correlation
+    """
+    x = x - x.mean(axis=1, keepdims=True)
+    norm = np.linalg.norm(x, axis=1, keepdims=True)
+    norm[norm == 0] = np.nan
+    return x / norm
+
+
+def iter_similarity_blocks(x, block_size=2000):
+    """
+    Yield the upper triangle of the Pearson correlation matrix of the rows of x, one
+    block of rows by columns at a time, without building the full matrix
+    Output:
+    (row indices, column indices, similarity) of the unique pairs in each block
+    """
+    x = standardize_profiles(np.asarray(x, dtype=np.float64))
+    n_samples = x.shape[0]
+    for row_start in range(0, n_samples, block_size):
+        row_index = np.arange(row_start, min(row_start + block_size, n_samples))
+        for col_start in range(row_start, n_samples, block_size):
+            col_index = np.arange(col_start, min(col_start + block_size, n_samples))
+            block = x[row_index] @ x[col_index].T
+
+            pair_a, pair_b = np.nonzero(row_index[:, None] < col_index[None, :])
+            similarity = block[pair_a, pair_b]
+            keep = ~np.isnan(similarity)
+            yield row_index[pair_a[keep]], col_index[pair_b[keep]], similarity[keep]
+
+
+def get_pair_histograms(df, features, pair_groups, bins=None, block_size=2000):
+    """
+    Stream pairwise Pearson correlations in blocks and accumulate one histogram per
+    combination of pair categories, instead of keeping every pair in memory
+
+    Arguments:
+    df - pandas dataframe of profiles
+    features - the feature columns
+    pair_groups - dictionary of category name to metadata columns: a pair belongs
+                  to the category if its two samples share all of these columns
+                  (e.g. {"replicate": audit_cols, "same_well": ["Metadata_Well"]})
+    bins - the histogram bin edges; defaults to 200 bins from -1 to 1
+    block_size - the number of profiles per block of the similarity matrix
+
+    Output:
+    pandas dataframe with one row per category combination and bin: a boolean
+    column per pair group, the bin start, end and center, and the pair count
+    """
+    if bins is None:
+        bins = np.linspace(-1, 1, 201)
+
+    group_names = list(pair_groups.keys())
+    group_codes = [get_group_codes(df, pair_groups[x]) for x in group_names]
+    n_bins = len(bins) - 1
+    n_categories = 2 ** len(group_names)
+
+    counts = np.zeros(n_categories * n_bins, dtype=np.int64)
+    x = df.loc[:, features].to_numpy(dtype=np.float64)
+    for pair_a, pair_b, similarity in iter_similarity_blocks(x, block_size=block_size):
+        category = np.zeros(len(similarity), dtype=np.int64)
+        for bit, codes in enumerate(group_codes):
+            category |= (codes[pair_a] == codes[pair_b]).astype(np.int64) << bit
+
+        bin_index = np.clip(np.searchsorted(bins, similarity, side="right") - 1, 0, n_bins - 1)
+        counts += np.bincount(category * n_bins + bin_index, minlength=len(counts))
+
+    category, bin_index = np.divmod(np.arange(len(counts)), n_bins)
+    hist_df = pd.DataFrame(
+        {
+            name: ((category >> bit) & 1).astype(bool)
+            for bit, name in enumerate(group_names)
+        }
+    ).assign(
+        bin_start=bins[bin_index],
+        bin_end=bins[bin_index + 1],
+        bin_center=(bins[bin_index] + bins[bin_index + 1]) / 2,
+        count=counts,
+    )
+    return hist_df
+
+
+def iter_batch_blocks(batch_codes, block_size=2000):
+    """
+    Yield the row and column indices of each batch by batch block of the similarity
+    matrix (upper block triangle), split in chunks of at most block_size profiles
+    """
+    batch_index = [np.flatnonzero(batch_codes == x) for x in np.unique(batch_codes)]
+    chunks = [
+        index[start : start + block_size]
+        for index in batch_index
+        for start in range(0, len(index), block_size)
+    ]
+    for chunk_a in range(len(chunks)):
+        for chunk_b in range(chunk_a, len(chunks)):
+            yield chunk_a == chunk_b, chunks[chunk_a], chunks[chunk_b]
+
+
+def get_cross_batch_similarity(
+    df,
+    features,
+    batch_col="Metadata_batch",
+    replicate_groups=["Metadata_clone_number", "Metadata_treatment"],
+    pair_a_groups=[],
+    bins=None,
+    block_size=2000,
+):
+    """
+    Aggregate all pairwise profile correlations into comparison categories
+
+    Pairs are categorized as in a melted cytominer_eval similarity matrix
+    (eval_metric="grit", both orientations of each pair, no self pairs): replicates
+    share all replicate_groups, and are in the same batch or across batches.
+
+    Arguments:
+    df - pandas dataframe of profiles from one or more batches
+    features - the feature columns
+    batch_col - the column identifying batches
+    replicate_groups - the columns defining replicates (besides the batch)
+    pair_a_groups - other columns of the first profile of each pair to aggregate by
+                    (e.g. to facet by clone)
+    bins - the histogram bin edges; defaults to 200 bins from -1 to 1
+    block_size - the maximum number of profiles per block
+
+    Output:
+    A dictionary of two dataframes, both per comparison_category, batch, and
+    pair_a_groups (suffixed with _pair_a): "histogram" (pair counts per bin) and
+    "stats" (n_pairs, sum, sum_sq, min and max of the similarities, see
+    summarize_similarity())
+    """
+    if bins is None:
+        bins = np.linspace(-1, 1, 201)
+
+    x = standardize_profiles(df.loc[:, features].to_numpy(dtype=np.float64))
+    batch_codes = get_group_codes(df, [batch_col], missing_match=True)
+    replicate_codes = get_group_codes(df, replicate_groups)
+
+    label_cols = [batch_col] + pair_a_groups
+    label_codes = get_group_codes(df, label_cols, missing_match=True)
+    n_labels = label_codes.max() + 1
+    n_bins = len(bins) - 1
+    n_keys = len(comparison_categories) * n_labels
+
+    counts = np.zeros(n_keys * n_bins, dtype=np.int64)
+    n_pairs = np.zeros(n_keys, dtype=np.int64)
+    sums = np.zeros(n_keys)
+    sums_sq = np.zeros(n_keys)
+    minimums = np.full(n_keys, np.inf)
+    maximums = np.full(n_keys, -np.inf)
+
+    def accumulate(similarity, category, labels):
+        keep = ~np.isnan(similarity)
+        similarity = similarity[keep]
+        key = category[keep] * n_labels + labels[keep]
+        bin_index = np.clip(
+            np.searchsorted(bins, similarity, side="right") - 1, 0, n_bins - 1
+        )
+
+        counts[:] += np.bincount(key * n_bins + bin_index, minlength=len(counts))
+        n_pairs[:] += np.bincount(key, minlength=n_keys)
+        sums[:] += np.bincount(key, weights=similarity, minlength=n_keys)
+        sums_sq[:] += np.bincount(key, weights=similarity ** 2, minlength=n_keys)
+        np.minimum.at(minimums, key, similarity)
+        np.maximum.at(maximums, key, similarity)
+
+    for diagonal, index_a, index_b in iter_batch_blocks(batch_codes, block_size):
+        similarity = x[index_a] @ x[index_b].T
+
+        same_batch = batch_codes[index_a][0] == batch_codes[index_b][0]
+        replicate = replicate_codes[index_a][:, None] == replicate_codes[index_b][None, :]
+        category = np.where(replicate, 0, 2) + (0 if same_batch else 1)
+
+        if diagonal:
+            # Both orientations of each pair are in the block; drop self pairs
+            not_self = ~np.eye(len(index_a), dtype=bool)
+            labels = np.broadcast_to(label_codes[index_a][:, None], similarity.shape)
+            accumulate(similarity[not_self], category[not_self], labels[not_self])
+        else:
+            # Count the block once with each side as the first profile of the pair
+            labels = np.broadcast_to(label_codes[index_a][:, None], similarity.shape)
+            accumulate(similarity.ravel(), category.ravel(), labels.ravel())
+            labels = np.broadcast_to(label_codes[index_b][None, :], similarity.shape)
+            accumulate(similarity.ravel(), category.ravel(), labels.ravel())
+
+    # Label each key with its comparison category and pair_a group values
+    first_index = np.unique(label_codes, return_index=True)[1]
+    label_df = (
+        df.iloc[first_index]
+        .loc[:, label_cols]
+        .reset_index(drop=True)
+        .rename(columns={x: f"{x}_pair_a" for x in label_cols})
+    )
+    key_df = pd.concat(
+        [label_df.assign(comparison_category=x) for x in comparison_categories],
+        ignore_index=True,
+    )
+
+    stats_df = key_df.assign(
+        n_pairs=n_pairs, sum=sums, sum_sq=sums_sq, min=minimums, max=maximums
+    ).query("n_pairs > 0")
+
+    bin_index = np.tile(np.arange(n_bins), n_keys)
+    hist_df = key_df.loc[np.repeat(np.arange(n_keys), n_bins)].reset_index(drop=True)
+    hist_df = hist_df.assign(
+        bin_start=bins[bin_index],
+        bin_end=bins[bin_index + 1],
+        bin_center=(bins[bin_index] + bins[bin_index + 1]) / 2,
+        count=counts,
+    )
+    hist_df = hist_df.loc[
+        hist_df.groupby(key_df.columns.tolist(), sort=False)["count"].transform("sum") > 0
+    ].reset_index(drop=True)
+
+    similarity_results = {"histogram": hist_df, "stats": stats_df.reset_index(drop=True)}
+    return similarity_results
+
+
+def get_histogram_density(hist_df, groups, smooth_bins=2):
+    """
+    Convert pair histograms to densities (each group integrates to one), optionally
+    smoothed with a gaussian kernel (in units of bins) to resemble a kernel density
+    """
+    hist_df = hist_df.groupby(groups + ["bin_start", "bin_end", "bin_center"]).agg(
+        {"count": "sum"}
+    ).reset_index()
+
+    if smooth_bins > 0:
+        offsets = np.arange(-4 * smooth_bins, 4 * smooth_bins + 1)
+        kernel = np.exp(-0.5 * (offsets / smooth_bins) ** 2)
+        kernel /= kernel.sum()
+    else:
+        kernel = np.ones(1)
+
+    density_dfs = []
+    for group_values, group_df in hist_df.groupby(groups):
+        group_df = group_df.sort_values("bin_start")
+        n_pairs = group_df.loc[:, "count"].sum()
+        if n_pairs == 0:
+            continue
+        bin_width = (group_df.bin_end - group_df.bin_start).to_numpy()
+        smoothed = np.convolve(group_df.loc[:, "count"].to_numpy(), kernel, mode="same")
+        density_dfs.append(
+            group_df.assign(n_pairs=n_pairs, density=smoothed / (n_pairs * bin_width))
+        )
+
+    return pd.concat(density_dfs).reset_index(drop=True)
+
+
+def get_histogram_quantile(hist_df, quantile):
+    """
+    Approximate quantile of the pairs summarized in a histogram (linear within bins)
+    """
+    hist_df = hist_df.groupby(["bin_start", "bin_end"]).agg({"count": "sum"}).reset_index()
+    hist_df = hist_df.loc[hist_df.loc[:, "count"] > 0]
+    counts = hist_df.loc[:, "count"].to_numpy()
+    if counts.sum() == 0:
+        return np.nan
+
+    cumulative = np.cumsum(counts) / counts.sum()
+    bin_index = min(np.searchsorted(cumulative, quantile), len(cumulative) - 1)
+    previous = cumulative[bin_index - 1] if bin_index > 0 else 0
+    fraction = np.clip((quantile - previous) / (cumulative[bin_index] - previous), 0, 1)
+    bin_start, bin_end = hist_df.iloc[bin_index][["bin_start", "bin_end"]]
+    return bin_start + fraction * (bin_end - bin_start)
+
+
+def summarize_similarity(similarity_results, groups=["comparison_category"]):
+    """
+    Summary statistics of the similarities per group of the aggregated keys:
+    number of pairs, mean, standard deviation, minimum, (approximate) median and
+    maximum
+    """
+    stats_df = similarity_results["stats"].groupby(groups).agg(
+        {"n_pairs": "sum", "sum": "sum", "sum_sq": "sum", "min": "min", "max": "max"}
+    )
+    mean = stats_df["sum"] / stats_df.n_pairs
+    variance = (stats_df.sum_sq - stats_df.n_pairs * mean ** 2) / (stats_df.n_pairs - 1)
+    stats_df = stats_df.assign(mean=mean, std=np.sqrt(variance.clip(lower=0)))
+
+    hist_df = similarity_results["histogram"].groupby(groups + ["bin_start", "bin_end"]).agg(
+        {"count": "sum"}
+    ).reset_index()
+    median = hist_df.groupby(groups).apply(get_histogram_quantile, quantile=0.5)
+
+    summary_df = stats_df.assign(median=median).loc[
+        :, ["n_pairs", "mean", "std", "min", "median", "max"]
+    ]
+    return summary_df.reset_index()
+
+
+def get_median_replicate_correlation(df, replicate_groups, pair_a, similarity):
+    """
+    Median correlation of the replicate pairs of each replicate group, with the
+    "_pair_a" suffixed group columns of cytominer_eval
+    """
+    pair_groups = [f"{group}_pair_a" for group in replicate_groups]
+    pair_df = (
+        df.iloc[pair_a]
+        .loc[:, replicate_groups]
+        .rename(columns=dict(zip(replicate_groups, pair_groups)))
+        .assign(similarity_metric=similarity)
+    )
+    return pair_df.groupby(pair_groups).similarity_metric.median().reset_index()
+
+
+def get_grit(
+    similarity_matrix,
+    profile_codes,
+    group_codes,
+    control_profiles,
+    summary_method="mean",
+    block_size=2000,
+):
+    """
+    Grit of each profile id, as in cytominer_eval operation="grit": the z-score of
+    the similarities of a profile to the other profiles of its group (excluding the
+    same profile id), relative to its similarities to the control profiles
+
+    Target similarities are summed over blocks of rows, with the columns sorted by
+    group and profile id so that np.add.reduceat sums each row per group and per
+    profile id; control similarities are matrix vector products. Apart from one
+    block of rows, no other samples x samples array is built.
+
+    Arguments:
+    similarity_matrix - profile by profile similarity matrix
+    profile_codes - integer code of the profile id of each profile
+    group_codes - integer code of the replicate group of each profile id (each
+                  profile id belongs to a single group)
+    control_profiles - boolean mask of control profiles
+    summary_method - summarize z-scores by "mean" or "median"
+    block_size - the number of rows of the similarity matrix summed at once
+
+    Output:
+    numpy array of the grit of each profile code (nan without group profiles)
+    """
+    n_samples = similarity_matrix.shape[0]
+    n_profiles = profile_codes.max() + 1
+    n_groups = group_codes.max() + 1
+    is_control = control_profiles.astype(np.float64)
+    self_similarity = np.diagonal(similarity_matrix)
+
+    first_index = np.unique(profile_codes, return_index=True)[1]
+    profile_group = group_codes[first_index]
+    profile_size = np.bincount(profile_codes, minlength=n_profiles)
+    group_size = np.bincount(group_codes, minlength=n_groups)
+
+    # Control similarity distribution of each profile id (self pairs excluded)
+    control_n = profile_size * is_control.sum() - np.bincount(
+        profile_codes, weights=is_control, minlength=n_profiles
+    )
+    control_sum = np.bincount(
+        profile_codes,
+        weights=similarity_matrix @ is_control - self_similarity * is_control,
+        minlength=n_profiles,
+    )
+    control_sq = np.bincount(
+        profile_codes,
+        weights=np.einsum("ij,ij,j->i", similarity_matrix, similarity_matrix, is_control)
+        - self_similarity ** 2 * is_control,
+        minlength=n_profiles,
+    )
+    control_mean = control_sum / control_n
+    control_std = np.sqrt(np.maximum(control_sq / control_n - control_mean ** 2, 0))
+    # A constant control distribution is not scaled (as StandardScaler)
+    control_std[control_std == 0] = 1
+
+    # Same group, different profile id
+    target_n = profile_size * (group_size[profile_group] - profile_size)
+    if summary_method == "mean":
+        # Columns sorted by group, then profile id, so both are contiguous runs
+        column_order = np.lexsort((profile_codes, group_codes))
+        sorted_groups = group_codes[column_order]
+        sorted_profiles = profile_codes[column_order]
+        group_starts = np.flatnonzero(np.r_[True, np.diff(sorted_groups) != 0])
+        profile_starts = np.flatnonzero(np.r_[True, np.diff(sorted_profiles) != 0])
+        group_run = np.zeros(n_groups, dtype=int)
+        group_run[sorted_groups[group_starts]] = np.arange(len(group_starts))
+        profile_run = np.zeros(n_profiles, dtype=int)
+        profile_run[sorted_profiles[profile_starts]] = np.arange(len(profile_starts))
+
+        # Similarity of each row to its group, minus to its own profile id
+        row_target_sum = np.empty(n_samples)
+        for start in range(0, n_samples, block_size):
+            rows = np.arange(start, min(start + block_size, n_samples))
+            block = similarity_matrix[start : start + block_size, column_order]
+            group_sums = np.add.reduceat(block, group_starts, axis=1)
+            profile_sums = np.add.reduceat(block, profile_starts, axis=1)
+            block_rows = np.arange(len(rows))
+            row_target_sum[rows] = (
+                group_sums[block_rows, group_run[group_codes[rows]]]
+                - profile_sums[block_rows, profile_run[profile_codes[rows]]]
+            )
+        target_sum = np.bincount(profile_codes, weights=row_target_sum, minlength=n_profiles)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            target_summary = np.where(target_n > 0, target_sum / target_n, np.nan)
+    elif summary_method == "median":
+        target_summary = np.full(n_profiles, np.nan)
+        for profile in np.flatnonzero(target_n > 0):
+            rows = profile_codes == profile
+            columns = (group_codes == profile_group[profile]) & ~rows
+            target_summary[profile] = np.median(similarity_matrix[np.ix_(rows, columns)])
+    else:
+        raise ValueError(f"summary_method '{summary_method}' is not supported")
+
+    return (target_summary - control_mean) / control_std
+
+
+def evaluate_profiles(
+    df,
+    features,
+    replicate_groups,
+    grit_profile_col,
+    grit_group_col,
+    grit_control_perts,
+    grit_subset=None,
+    quantile=0.95,
+    similarity_metric="pearson",
+    similarity_matrix=None,
+):
+    """
+    Percent strong, median replicate correlation, and grit of the same profiles
+    from one similarity matrix and integer coded groups
+
+    Arguments:
+    df - pandas dataframe of profiles
+    features - the feature columns
+    replicate_groups - the columns defining replicates for percent strong
+    grit_profile_col - the column identifying profiles for grit
+    grit_group_col - the column identifying replicate groups for grit
+    grit_control_perts - the grit_profile_col values of control profiles
+    grit_subset - optional boolean mask of the profiles to compute grit for
+    quantile - the quantile of the non replicate distribution for percent strong
+    similarity_metric - "pearson" or "spearman"
+    similarity_matrix - optionally, a precomputed get_similarity_matrix(df, features)
+
+    Output:
+    A dictionary of the percent strong, the null cutoff, the median replicate
+    correlation per replicate group (median_cor_df), and the grit per profile id
+    (grit_df, with perturbation, group, and grit columns)
+    """
+    if similarity_matrix is None:
+        similarity_matrix = get_similarity_matrix(
+            df, features, similarity_metric=similarity_metric
+        )
+
+    pair_a, pair_b, similarity = get_upper_pairs(similarity_matrix)
+    replicate_codes = get_group_codes(df, replicate_groups)
+    replicate_mask = replicate_codes[pair_a] == replicate_codes[pair_b]
+
+    cutoff, percent_strong = get_percent_strong(
+        similarity, replicate_mask, quantile=quantile
+    )
+    median_cor_df = get_median_replicate_correlation(
+        df, replicate_groups, pair_a[replicate_mask], similarity[replicate_mask]
+    )
+
+    # Reuse the same matrix for the grit profiles
+    if grit_subset is None:
+        grit_subset = np.ones(df.shape[0], dtype=bool)
+    grit_index = np.flatnonzero(np.asarray(grit_subset))
+    grit_profile_df = df.iloc[grit_index]
+
+    profile_codes, profiles = pd.factorize(grit_profile_df.loc[:, grit_profile_col], sort=True)
+    group_codes, groups = pd.factorize(grit_profile_df.loc[:, grit_group_col])
+    control_profiles = grit_profile_df.loc[:, grit_profile_col].isin(grit_control_perts).to_numpy()
+
+    if grit_index.shape[0] < df.shape[0]:
+        similarity_matrix = similarity_matrix[np.ix_(grit_index, grit_index)]
+    grit = get_grit(
+        similarity_matrix,
+        profile_codes,
+        group_codes,
+        control_profiles,
+    )
+    first_index = np.unique(profile_codes, return_index=True)[1]
+    grit_df = pd.DataFrame(
+        {
+            "perturbation": profiles,
+            "group": groups.take(group_codes[first_index]),
+            "grit": grit,
+        }
+    )
+
+    evaluate_results = {
+        "percent_strong": percent_strong,
+        "cutoff": cutoff,
+        "median_cor_df": median_cor_df,
+        "grit_df": grit_df,
+    }
+    return evaluate_results